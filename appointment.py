@@ -4,40 +4,377 @@
 ''' Appointments. '''
 
 import os
+import bisect
+import csv
 import datetime
 import functools
+import hashlib
+import itertools
+import logging
+import random
+import re
+import time
 import urllib
+from email.utils import parsedate
+from StringIO import StringIO
 
 # GAE imports
 from google.appengine.api import users
-from google.appengine.api import mail
-from google.appengine.api import images
+from google.appengine.api import memcache
 from google.appengine.ext import webapp
+try:
+    from google.appengine.api import taskqueue
+except ImportError:
+    from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
-from google.appengine.ext import search
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp import blobstore_handlers
 from google.appengine.ext.webapp.util import run_wsgi_app
 from django.utils import simplejson
+from django.template import Context
 
 # Use Django translation
 os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
 from django.conf import settings as django_settings
 django_settings._target = None
-from django.utils import translation
 
 # Project imports
 import settings
+import instrumentation
+import assets
 
-# Add custom Django template filters/tags
-template.register_template_library('templatetags')
 
+class LazyModule(object):
+    '''
+    Module imported on first use of one of its attributes, so that requests
+    which do not need it do not pay for its import.
+
+    >>> calendar = LazyModule('calendar')
+    >>> calendar.isleap(2012)
+    True
+    '''
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = __import__(self._name, {}, {}, ['__name__'])
+        return getattr(self._module, attr)
+
+
+# Services used by few requests: mail by invitation tasks, images by
+# renditions, translation by pages
+mail = LazyModule('google.appengine.api.mail')
+images = LazyModule('google.appengine.api.images')
+translation = LazyModule('django.utils.translation')
+
+
+# Debug mode (template reloading, tracebacks) only on the development server
+_DEBUG = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+
+# Maximum number of entities written by a single datastore put
+_PUT_BATCH_SIZE = 500
+
+# Maximum number of appointments accepted by one bulk creation request, and
+# of person and date pairs across them, which bounds the records written
+_BULK_LIMIT = 100
+_BULK_RECORD_LIMIT = 10000
+
+# Most status changes accepted by one bulk availability request, all
+# written by a single put
+_BULK_STATUS_LIMIT = 500
+
+# Invitations sent by a single mail task; tasks of a fan-out run in parallel
+_MAIL_BATCH_SIZE = 50
+
+# Times a failed invitation is queued again before giving up
+_MAIL_RETRIES = 5
+
+# Entities fetched per datastore RPC when iterating large queries
+_QUERY_BATCH_SIZE = 1000
+
+# Invitee availability values
+_STATUSES = ('yes', 'maybe', 'no')
+
+# Availability storage: one Invite per person and date, or one compact
+# Availability record per person
+_STORAGE_MODES = ('invites', 'compact')
+_DEFAULT_STORAGE = 'invites'
+
+# Counter shards per appointment, spreading concurrent availability updates
+_TALLY_SHARDS = 10
+
+# Widths of the photo renditions served by ThumbHandler and PhotosHandler
+_THUMB_WIDTH = 150
+_PHOTO_WIDTH = 500
+
+# Seconds browsers and shared caches may keep a downloaded blob. Blobs never
+# change, but a public one may stop being shared
+_BLOB_MAX_AGE = 7 * 24 * 3600
+
+# Thumbnail sprites: side of the square cell of each photo, photos per
+# sprite and sprite columns
+_SPRITE_CELL = 60
+_SPRITE_PAGE = 100
+_SPRITE_COLUMNS = 10
+
+# Seconds browsers may keep content addressed resources, such as sprites
+_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
 
-_DEBUG = True
+# Comment keywords: indexed prefixes run from _KEYWORD_MIN to _KEYWORD_MAX
+# characters, a query uses at most _SEARCH_TERMS words
+_KEYWORD_MIN = 2
+_KEYWORD_MAX = 20
+_SEARCH_TERMS = 5
 
+# Search results per page
+_SEARCH_PAGE = 20
 
-class Appointment(db.Model):
+# Entities re-saved by each keyword reindexing task
+_REINDEX_BATCH_SIZE = 100
+
+# Most entities of each kind listed on a profile page
+_PROFILE_LIMIT = 100
+
+# Calendar feeds: most owned and most invited appointments in a feed,
+# seconds clients may use a feed and seconds memcache keeps it
+_CALENDAR_LIMIT = 500
+_CALENDAR_MAX_AGE = 900
+_CALENDAR_CACHE_TIME = 24 * 3600
+
+# Length of an appointment, in minutes: dates closer than this conflict
+_EVENT_MINUTES = 60
+
+# Most people whose conflicts are checked in one request
+_FREEBUSY_LIMIT = 50
+
+# Most people whose busy indexes one task updates
+_FREEBUSY_TASK_SIZE = 100
+
+# Most login and logout URLs cached per instance
+_AUTH_URL_CACHE_SIZE = 1000
+
+# Entity cache: entities kept by each instance, seconds an instance trusts
+# its copy and seconds memcache refuses write-backs after an update
+_LOCAL_CACHE_SIZE = 1000
+_LOCAL_CACHE_TTL = 10
+_CACHE_LOCK_TIME = 32
+
+# Entities removed by each delete RPC of a cascading delete. Appointments
+# with more invites are removed by a background task.
+_DELETE_BATCH_SIZE = 400
+
+# Invites moved to deterministic keys by each migration task
+_MIGRATE_BATCH_SIZE = 200
+
+# Appointments re-saved by each date backfill task, and default seconds
+# between two tasks
+_BACKFILL_BATCH_SIZE = 100
+_BACKFILL_COUNTDOWN = 1
+
+# Default and largest page sizes of paginated lists
+_PAGE_SIZE = 20
+_MAX_PAGE_SIZE = 100
+
+# Exports read _EXPORT_BATCH_SIZE entities per query batch and write at most
+# _EXPORT_LIMIT per response, or _EXPORT_APPOINTMENT_LIMIT appointments as
+# each one takes a query of its statuses; the CSV columns of each kind
+_EXPORT_BATCH_SIZE = 100
+_EXPORT_LIMIT = 2000
+_EXPORT_APPOINTMENT_LIMIT = 200
+_EXPORT_COLUMNS = {
+    'appointments': ('key', 'description', 'name', 'email', 'storage', 'date', 'invitee', 'status'),
+    'photos': ('key', 'user', 'comment', 'public', 'url'),
+    'files': ('key', 'user', 'comment', 'public', 'filename', 'url'),
+    }
+
+# Imports create _IMPORT_BATCH_SIZE appointments per batch of puts and at
+# most _IMPORT_LIMIT per request
+_IMPORT_BATCH_SIZE = 50
+_IMPORT_LIMIT = 500
+
+
+class LRUCache(object):
+    '''
+    In-memory cache holding at most size entries, each for ttl seconds. When
+    full, the least recently used entries are dropped.
+
+    >>> cache = LRUCache(size=2, ttl=60)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> cache.get('b') is None
+    True
+    '''
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = {}
+        self._tick = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires, used = entry
+        if expires < time.time():
+            del self._entries[key]
+            return None
+        self._tick += 1
+        self._entries[key] = (value, expires, self._tick)
+        return value
+
+    def set(self, key, value):
+        self._tick += 1
+        self._entries[key] = (value, time.time() + self.ttl, self._tick)
+        if len(self._entries) > self.size:
+            # Dropping a quarter at once keeps the sort cost amortized
+            entries = sorted(self._entries.items(), key=lambda item: item[1][2])
+            for key, entry in entries[:len(entries) // 4 + 1]:
+                del self._entries[key]
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachedModel(db.Model):
+    '''
+    Model whose get() reads through an instance-local LRUCache, then
+    memcache, then the datastore. put() and delete() invalidate both tiers.
+
+    Invalidation leaves a lock in memcache for _CACHE_LOCK_TIME seconds.
+    Readers only write entities back with memcache add, which fails while the
+    lock or a newer copy is there, so a reader that fetched an entity before
+    an update cannot put the stale copy back afterwards. Other instances may
+    serve their local copy for up to _LOCAL_CACHE_TTL seconds.
+    '''
+    _local = LRUCache(_LOCAL_CACHE_SIZE, _LOCAL_CACHE_TTL)
+    _LOCKED = 'locked'
+    stats = {'local_hits': 0, 'memcache_hits': 0, 'misses': 0}
+
+    @classmethod
+    def get(cls, keys, **kwargs):
+        multiple = isinstance(keys, (list, tuple))
+        if not multiple:
+            keys = [keys]
+        keys = [str(k) for k in keys]
+        for k in keys:
+            db.Key(k)
+
+        found = {}
+        missing = []
+        for k in keys:
+            data = CachedModel._local.get(k)
+            if data is None:
+                missing.append(k)
+            else:
+                found[k] = data
+                CachedModel.stats['local_hits'] += 1
+
+        if missing:
+            cached = memcache.get_multi(missing, key_prefix='entity:')
+            locked = set(k for k in missing if cached.get(k) == CachedModel._LOCKED)
+            to_fetch = []
+            for k in missing:
+                if k in cached and k not in locked:
+                    found[k] = cached[k]
+                    CachedModel._local.set(k, cached[k])
+                    CachedModel.stats['memcache_hits'] += 1
+                else:
+                    to_fetch.append(k)
+
+            if to_fetch:
+                CachedModel.stats['misses'] += len(to_fetch)
+                write_back = {}
+                for k, entity in zip(to_fetch, db.get(to_fetch, **kwargs)):
+                    if entity is None:
+                        continue
+                    data = db.model_to_protobuf(entity).Encode()
+                    found[k] = data
+                    if k not in locked:
+                        write_back[k] = data
+                        CachedModel._local.set(k, data)
+                if write_back:
+                    memcache.add_multi(write_back, key_prefix='entity:')
+
+        entities = []
+        for k in keys:
+            entity = None
+            if k in found:
+                entity = db.model_from_protobuf(entity_pb.EntityProto(found[k]))
+                if not isinstance(entity, cls):
+                    raise db.KindError('Kind %r is not a subclass of kind %r' % (entity.kind(), cls.kind()))
+            entities.append(entity)
+        if multiple:
+            return entities
+        return entities[0]
+
+    @staticmethod
+    def invalidate(keys):
+        keys = [str(k) for k in keys]
+        for k in keys:
+            CachedModel._local.delete(k)
+        memcache.set_multi(dict((k, CachedModel._LOCKED) for k in keys), time=_CACHE_LOCK_TIME, key_prefix='entity:')
+
+    def put(self, **kwargs):
+        key = super(CachedModel, self).put(**kwargs)
+        CachedModel.invalidate([key])
+        return key
+
+    def delete(self, **kwargs):
+        key = self.key()
+        super(CachedModel, self).delete(**kwargs)
+        CachedModel.invalidate([key])
+
+
+def date_bound(dates, bound, now=None):
+    '''
+    The first, last or next (first not passed at now, by default the
+    current time) of dates, or None.
+
+    >>> dates = [datetime.datetime(2012, 12, d) for d in (21, 24, 22)]
+    >>> date_bound(dates, 'last')
+    datetime.datetime(2012, 12, 24, 0, 0)
+    >>> date_bound(dates, 'next', now=datetime.datetime(2012, 12, 22))
+    datetime.datetime(2012, 12, 22, 0, 0)
+    >>> date_bound(dates, 'next', now=datetime.datetime(2013, 1, 1))
+    '''
+    if bound == 'next':
+        now = now or datetime.datetime.utcnow()
+        dates = [d for d in dates if d >= now]
+    if not dates:
+        return None
+    if bound == 'last':
+        return max(dates)
+    return min(dates)
+
+
+class DateBoundProperty(db.DateTimeProperty):
+    '''
+    First, last or next date of the date_list of an appointment, computed
+    whenever it is saved. It is never assigned; it only exists to be
+    queried. The next date is the one upcoming at the time of the save.
+    '''
+    def __init__(self, bound, **kwargs):
+        super(DateBoundProperty, self).__init__(**kwargs)
+        self.bound = bound
+
+    def get_value_for_datastore(self, model_instance):
+        return date_bound(model_instance.date_list, self.bound)
+
+
+class Appointment(CachedModel):
     '''
     Provides appointment storage. To create an appointment use:
 
@@ -58,11 +395,387 @@ class Appointment(db.Model):
     date_list = db.ListProperty(datetime.datetime)
     name = db.StringProperty(required=True)
     email = db.EmailProperty(required=True)
+    deleted = db.BooleanProperty(default=False)
+    storage = db.StringProperty(default='invites', choices=_STORAGE_MODES)
+    date_slots = db.ListProperty(int)
+    next_slot = db.IntegerProperty(default=0)
+    first_date = DateBoundProperty('first')
+    last_date = DateBoundProperty('last')
+    next_date = DateBoundProperty('next')
+
+    @staticmethod
+    def upcoming(query, now=None):
+        '''
+        Filters and sorts query to the appointments with a date not passed,
+        next first. Next dates are as of the last save and the daily
+        /tasks/backfill_dates run, so the ones of today are kept until then.
+        '''
+        today = (now or datetime.datetime.utcnow()).replace(hour=0, minute=0, second=0, microsecond=0)
+        return query.filter('next_date >=', today).order('next_date')
+
+    @staticmethod
+    def past(query, now=None):
+        ''' Filters and sorts query to the appointments whose dates all passed, latest first. '''
+        return query.filter('last_date <', now or datetime.datetime.utcnow()).order('-last_date')
 
     @property
     def dates(self):
         return ', '.join([d.strftime(settings.DATETIME_FORMAT) for d in self.date_list])
 
+    def to_dict(self):
+        return {
+            'key': str(self.key()),
+            'description': self.description,
+            'name': self.name,
+            'email': self.email,
+            'invitees': list(self.invitee_list),
+            'dates': [d.strftime(settings.DATETIME_FORMAT) for d in self.date_list],
+            }
+
+    @property
+    def people(self):
+        ''' The owner followed by the invitees, each e-mail once. '''
+        people = [self.email]
+        for email in self.invitee_list:
+            if email not in people:
+                people.append(email)
+        return people
+
+    def default_status(self, email):
+        ''' Status of a person who did not answer: 'yes' for the owner. '''
+        return email == self.email and 'yes' or 'maybe'
+
+    @property
+    def slots(self):
+        '''
+        Slot of each date of date_list. Tally counters and compact statuses
+        are stored by slot, so dates can be added and removed without moving
+        them. Appointments saved before slots existed use the date positions.
+        '''
+        if len(self.date_slots) == len(self.date_list):
+            return list(self.date_slots)
+        return range(len(self.date_list))
+
+    @property
+    def slot_count(self):
+        ''' Number of slots ever used, the size of counter and status arrays. '''
+        return max([self.next_slot] + [s + 1 for s in self.slots])
+
+    def slot(self, date):
+        return self.slots[self.date_list.index(date)]
+
+    def make_records(self):
+        '''
+        Builds, without saving, the availability records of a new
+        appointment: invites or, in compact storage, Availability records.
+        '''
+        if self.storage == 'compact':
+            return self.make_availabilities()
+        return self.make_invites()
+
+    def make_invites(self):
+        '''
+        Builds, without saving, one invite per date for the owner (status
+        'yes') and for each invitee (status 'maybe').
+        '''
+        invites = []
+        for date in self.date_list:
+            for email in self.people:
+                invites.append(Invite(
+                    parent=self,
+                    key_name=Invite.key_name(email, date),
+                    email=email,
+                    date=date,
+                    appointment=self,
+                    status=self.default_status(email),
+                    ))
+        return invites
+
+    def make_availabilities(self):
+        ''' Builds, without saving, one Availability record per person. '''
+        return [Availability(
+            parent=self,
+            key_name=email,
+            statuses=Availability.CODES[self.default_status(email)] * self.slot_count,
+            ) for email in self.people]
+
+    def get_invite(self, email, date):
+        '''
+        Returns the invite of email on date, or None. In compact storage the
+        invite is built, unsaved, from the Availability record.
+        '''
+        if date not in self.date_list:
+            return None
+        if self.storage == 'compact':
+            record = Availability.get(Availability.key_for(self.key(), email))
+            if record is None:
+                return None
+            status = record.status(self.slot(date), self.default_status(email))
+            return Invite(email=email, date=date, status=status, appointment=self)
+        return Invite.lookup(self, email, date)
+
+    def set_status(self, email, date, status):
+        '''
+        Changes the status of email on date in a transaction. Returns the
+        previous status, or None if email is not invited.
+        '''
+        applied = self.set_statuses([(email, date, status)])
+        if not applied:
+            return None
+        return applied[0][2]
+
+    def set_statuses(self, changes):
+        '''
+        Applies changes, (email, date, status) tuples, with one transactional
+        batch read-modify-write of the records, then updates the tally, the
+        calendar feeds and the busy indexes. Changes of people not invited,
+        of dates not proposed or to unknown statuses are ignored; the last
+        change of an invite wins. Returns (email, date, old status, status)
+        for each change applied.
+        '''
+        latest = {}
+        for email, date, status in changes:
+            if date in self.date_list and status in _STATUSES:
+                latest[(email, date)] = status
+        changes = [(email, date, status) for (email, date), status in latest.items()]
+        if not changes:
+            return []
+        if self.storage == 'compact':
+            applied = Availability.set_statuses(self, changes)
+        else:
+            applied = Invite.set_statuses(self, changes)
+
+        changed = [c for c in applied if c[2] != c[3]]
+        if changed:
+            AvailabilityTally.update(self, [(date, old, new) for email, date, old, new in changed])
+            invalidate_calendars(set([c[0] for c in changed]))
+        busy = set([email for email, date, old, new in changed if 'yes' in (old, new)])
+        FreeBusy.refresh(dict((email, [self.key()]) for email in busy))
+        return applied
+
+    def statuses_of(self, email):
+        ''' Status list of email aligned with the dates, None for a missing record. '''
+        if self.storage == 'compact':
+            record = Availability.get_by_key_name(email, parent=self)
+            if record is None:
+                return [None] * len(self.date_list)
+            default = self.default_status(email)
+            return [record.status(slot, default) for slot in self.slots]
+        invites = db.get([Invite.key_for(self.key(), email, date) for date in self.date_list])
+        for i, date in enumerate(self.date_list):
+            if invites[i] is None:
+                invites[i] = Invite.legacy_query(self, email, date).get()
+        return [invite and invite.status or None for invite in invites]
+
+    def add_date(self, date):
+        '''
+        Adds a proposed date in a new slot. Everybody starts with the default
+        status. Compact records are not rewritten: slots past the end of a
+        status string read as the default.
+        '''
+        def txn():
+            appointment = db.get(self.key())
+            if date in appointment.date_list:
+                return None
+            slot = appointment.slot_count
+            appointment.date_slots = appointment.slots + [slot]
+            appointment.date_list = appointment.date_list + [date]
+            appointment.next_slot = slot + 1
+            appointment.put()
+            return appointment
+        appointment = db.run_in_transaction(txn)
+        if appointment is None:
+            return
+        invalidate_calendars(appointment.people)
+        FreeBusy.update(appointment.email, add=[(date, appointment.key())])
+        if appointment.storage != 'compact':
+            put_batched([Invite(
+                parent=appointment,
+                key_name=Invite.key_name(email, date),
+                email=email,
+                date=date,
+                appointment=appointment,
+                status=appointment.default_status(email),
+                ) for email in appointment.people])
+        AvailabilityTally.update(appointment, [(date, None, appointment.default_status(e)) for e in appointment.people])
+
+    def remove_date(self, date):
+        '''
+        Removes a proposed date. Its slot is never reused, so compact records
+        and tallies keep their stale value there untouched.
+        '''
+        def txn():
+            appointment = db.get(self.key())
+            if date not in appointment.date_list:
+                return None
+            i = appointment.date_list.index(date)
+            slots = appointment.slots
+            appointment.next_slot = appointment.slot_count
+            appointment.date_slots = slots[:i] + slots[i + 1:]
+            appointment.date_list = appointment.date_list[:i] + appointment.date_list[i + 1:]
+            appointment.put()
+            return appointment
+        appointment = db.run_in_transaction(txn)
+        if appointment is not None:
+            invalidate_calendars(appointment.people)
+        if appointment is not None and appointment.storage != 'compact':
+            db.delete([Invite.key_for(appointment.key(), email, date) for email in appointment.people])
+
+    def status_query(self):
+        '''
+        Strongly consistent query of the status records: the Availability or
+        Invite children of the appointment.
+        '''
+        if self.storage == 'compact':
+            return Availability.all().ancestor(self)
+        return Invite.all().ancestor(self)
+
+    def availability_matrix(self, records=None):
+        '''
+        Returns the status of every person on every date, read with a single
+        query, or from records, the already started run() of status_query():
+
+            {'dates': ['2012-12-21 12:00', ...],
+             'people': ['john@example.com', 'test@example.com', ...],
+             'status': {'test@example.com': ['maybe', ...], ...}}
+
+        Status lists are aligned with dates; None marks a missing invite.
+        Missing invites are looked for once more among the invites saved
+        before they were children of their appointment, until those are
+        migrated.
+        '''
+        if records is None:
+            records = self.status_query().run(batch_size=_QUERY_BATCH_SIZE)
+        dates = [d.strftime(settings.DATETIME_FORMAT) for d in self.date_list]
+        people = self.people
+        status = dict((e, [None] * len(dates)) for e in people)
+        if self.storage == 'compact':
+            slots = self.slots
+            for record in records:
+                email = record.key().name()
+                if email in status:
+                    default = self.default_status(email)
+                    status[email] = [record.status(slot, default) for slot in slots]
+        else:
+            index = dict((d, i) for i, d in enumerate(self.date_list))
+            for invite in records:
+                if invite.email in status and invite.date in index:
+                    status[invite.email][index[invite.date]] = invite.status
+            if [row for row in status.values() if None in row]:
+                legacy = Invite.all().filter('appointment =', self)
+                for invite in legacy.run(batch_size=_QUERY_BATCH_SIZE):
+                    row = status.get(invite.email)
+                    if row and invite.date in index and row[index[invite.date]] is None:
+                        row[index[invite.date]] = invite.status
+        return {'dates': dates, 'people': people, 'status': status}
+
+    @staticmethod
+    def availability_matrices(appointments):
+        ''' availability_matrix() of each appointment, starting every query before waiting for any. '''
+        running = [a.status_query().run(batch_size=_QUERY_BATCH_SIZE) for a in appointments]
+        return [a.availability_matrix(records) for a, records in zip(appointments, running)]
+
+    def tally_keys(self):
+        ''' Keys of the AvailabilityTally shards of this appointment. '''
+        return [AvailabilityTally.shard_key(self.key(), i) for i in range(_TALLY_SHARDS)]
+
+    def make_tally(self, status=None):
+        '''
+        Builds, without saving, the first tally shard: for new records or,
+        given status lists by e-mail as in availability_matrix(), counting
+        them. People without a list have their default status.
+        '''
+        slots = self.slots
+        shard = AvailabilityTally(key=AvailabilityTally.shard_key(self.key(), 0))
+        if status is None:
+            status = {}
+        for s in _STATUSES:
+            counts = [0] * self.slot_count
+            for email in self.people:
+                row = status.get(email) or [self.default_status(email)] * len(slots)
+                for i, value in enumerate(row):
+                    if value == s:
+                        counts[slots[i]] += 1
+            setattr(shard, s, counts)
+        return shard
+
+    def clean_statuses(self, status):
+        '''
+        Status lists by e-mail of every person from status, as in
+        availability_matrix(), cut to the dates and padded with the default
+        status, which also replaces missing or unknown values.
+        '''
+        size = len(self.date_list)
+        rows = {}
+        for email in self.people:
+            default = self.default_status(email)
+            row = list(status.get(email) or [])[:size]
+            rows[email] = [s in _STATUSES and s or default for s in row] + [default] * (size - len(row))
+        return rows
+
+    def apply_statuses(self, records, status):
+        '''
+        Sets, before they are saved, the statuses of records built by
+        make_records() from status lists by e-mail, as in
+        availability_matrix(). Unknown statuses are left to the default.
+        '''
+        slots = self.slots
+        index = dict((d, i) for i, d in enumerate(self.date_list))
+        for record in records:
+            if isinstance(record, Availability):
+                row = status.get(record.key().name()) or []
+                codes = list(record.statuses)
+                for slot, value in zip(slots, row):
+                    if value in _STATUSES:
+                        codes[slot] = Availability.CODES[value]
+                record.statuses = u''.join(codes)
+            else:
+                row = status.get(record.email) or []
+                i = index[record.date]
+                if i < len(row) and row[i] in _STATUSES:
+                    record.status = row[i]
+
+    def tally(self):
+        '''
+        Returns {'yes': [...], 'maybe': [...], 'no': [...]}, the number of
+        people with each status on each date, summing the tally shards with a
+        single batch get. Appointments created before tallies existed are
+        counted from their records once and the result is stored.
+        '''
+        shards = [t for t in db.get(self.tally_keys()) if t]
+        if not shards:
+            shards = [self.rebuild_tally()]
+        totals = {}
+        for status in _STATUSES:
+            by_slot = [0] * self.slot_count
+            for shard in shards:
+                for slot, count in enumerate(getattr(shard, status)[:len(by_slot)]):
+                    by_slot[slot] += count
+            totals[status] = [by_slot[slot] for slot in self.slots]
+        return totals
+
+    def rebuild_tally(self):
+        ''' Counts statuses from the records and stores them as the only shard. '''
+        shard = self.make_tally(self.availability_matrix()['status'])
+        db.delete(self.tally_keys()[1:])
+        shard.put()
+        return shard
+
+    def ranked_dates(self):
+        '''
+        Returns the dates with their counts, most available first: by number
+        of 'yes', then 'maybe', then fewest 'no'.
+        '''
+        totals = self.tally()
+        ranking = [{
+            'date': d.strftime(settings.DATETIME_FORMAT),
+            'yes': totals['yes'][i],
+            'maybe': totals['maybe'][i],
+            'no': totals['no'][i],
+            } for i, d in enumerate(self.date_list)]
+        ranking.sort(key=lambda r: (-r['yes'], -r['maybe'], r['no']))
+        return ranking
+
     def __repr__(self):
         return 'Appointment(description=%r, invitee_list=%r, date_list=%r, name=%r, email=%r)' % (self.description, self.invitee_list, self.date_list, self.name, self.email)
 
@@ -95,17 +808,284 @@ class Invite(db.Model):
     status = db.StringProperty(required=True)
     appointment = db.ReferenceProperty(Appointment)
 
+    @staticmethod
+    def key_name(email, date):
+        return '%s/%s' % (date.strftime('%Y%m%d%H%M'), email)
+
+    @staticmethod
+    def key_for(appointment_key, email, date):
+        '''
+        Invites are children of their appointment, named after the date and
+        e-mail, so an invite is read by key instead of by a query.
+        '''
+        return db.Key.from_path('Invite', Invite.key_name(email, date), parent=appointment_key)
+
+    @staticmethod
+    def lookup(appointment, email, date):
+        '''
+        Returns the invite of email on date. Invites saved before keys were
+        deterministic are still found with a query until they are migrated.
+        '''
+        invite = Invite.get(Invite.key_for(appointment.key(), email, date))
+        if invite is None:
+            invite = Invite.legacy_query(appointment, email, date).get()
+        return invite
+
+    @staticmethod
+    def legacy_query(appointment, email, date, keys_only=False):
+        return Invite.all(keys_only=keys_only).filter('email =', email).filter('date =', date).filter('appointment =', appointment)
+
+    @staticmethod
+    def set_status(appointment, email, date, status):
+        '''
+        Changes the status of an invite with a transactional read-modify-write.
+        Returns the previous status, or None if there is no such invite.
+        '''
+        def txn(key):
+            invite = Invite.get(key)
+            if invite is None:
+                return None
+            old = invite.status
+            invite.status = status
+            invite.put()
+            return old
+        old = db.run_in_transaction(txn, Invite.key_for(appointment.key(), email, date))
+        if old is None:
+            key = Invite.legacy_query(appointment, email, date, keys_only=True).get()
+            if key:
+                old = db.run_in_transaction(txn, key)
+        return old
+
+    @staticmethod
+    def set_statuses(appointment, changes):
+        '''
+        Changes the statuses of invites, (email, date, status) tuples, with
+        one transactional batch get and put in the appointment entity group.
+        Invites saved before deterministic keys are changed one by one.
+        Returns (email, date, old status, status) for each invite found.
+        '''
+        keys = [Invite.key_for(appointment.key(), email, date) for email, date, status in changes]
+        def txn():
+            applied = []
+            dirty = []
+            for invite, (email, date, status) in zip(db.get(keys), changes):
+                if invite is None:
+                    continue
+                applied.append((email, date, invite.status, status))
+                if invite.status != status:
+                    invite.status = status
+                    dirty.append(invite)
+            db.put(dirty)
+            return applied
+        applied = db.run_in_transaction(txn)
+        found = set([(email, date) for email, date, old, status in applied])
+        for email, date, status in changes:
+            if (email, date) not in found:
+                old = Invite.set_status(appointment, email, date, status)
+                if old is not None:
+                    applied.append((email, date, old, status))
+        return applied
+
     def __repr__(self):
         return 'Invite(email=%r, date=%r, status=%r, appointment=%r)' % (self.email, self.date, self.status, self.appointment)
 
 
-class Photo(db.Model):
+class AvailabilityTally(db.Model):
+    '''
+    One shard of the per-date status counters of an appointment. Counter lists
+    are indexed by Appointment.slots. Shards are root entities, so updates to
+    different shards never contend.
+    '''
+    yes = db.ListProperty(int)
+    maybe = db.ListProperty(int)
+    no = db.ListProperty(int)
+
+    @staticmethod
+    def shard_key(appointment_key, shard):
+        return db.Key.from_path('AvailabilityTally', '%s:%d' % (appointment_key, shard))
+
+    @staticmethod
+    def update(appointment, changes):
+        '''
+        Applies changes, a list of (date, old status, new status), to a random
+        shard in a transaction. old status is None for new invites. Called
+        once the records are saved: appointments created before tallies
+        existed have theirs counted from the records instead, which already
+        include the changes.
+        '''
+        if not [t for t in db.get(appointment.tally_keys()) if t]:
+            appointment.rebuild_tally()
+            return
+        key = AvailabilityTally.shard_key(appointment.key(), random.randrange(_TALLY_SHARDS))
+        size = appointment.slot_count
+        def txn():
+            tally = AvailabilityTally.get(key)
+            if not tally:
+                tally = AvailabilityTally(key=key, yes=[0] * size, maybe=[0] * size, no=[0] * size)
+            for date, old, new in changes:
+                i = appointment.slot(date)
+                for status, delta in ((old, -1), (new, 1)):
+                    if status in _STATUSES:
+                        counts = getattr(tally, status)
+                        counts.extend([0] * (size - len(counts)))
+                        counts[i] += delta
+                        setattr(tally, status, counts)
+            tally.put()
+        db.run_in_transaction(txn)
+
+
+def tokenize(text):
+    '''
+    Returns the distinct lowercase words of text.
+
+    >>> sorted(tokenize(u'Party at John\'s, party!'))
+    [u'at', u'john', u'party', u's']
+    '''
+    return set(re.findall(r'\w+', (text or u'').lower(), re.UNICODE))
+
+
+def keywords(text):
+    '''
+    Returns the indexed keywords of text: every prefix of each word, so an
+    equality filter on a keyword also matches longer words.
+
+    >>> sorted(keywords(u'Beach'))
+    [u'be', u'bea', u'beac', u'beach']
+    '''
+    prefixes = set()
+    for word in tokenize(text):
+        word = word[:_KEYWORD_MAX]
+        for i in range(min(_KEYWORD_MIN, len(word)), len(word) + 1):
+            prefixes.add(word[:i])
+    return sorted(prefixes)
+
+
+class KeywordsProperty(db.StringListProperty):
+    '''
+    Keywords of the comment of a model, computed whenever it is saved. It is
+    never assigned; it only exists to be queried.
+    '''
+    def get_value_for_datastore(self, model_instance):
+        return keywords(model_instance.comment)
+
+
+def fetch_page(query, cursor=None, size=_PAGE_SIZE):
+    '''
+    Returns a page of query results and the cursor of the next page, or None
+    on the last page.
+    '''
+    if cursor:
+        query.with_cursor(cursor)
+    results = query.fetch(size)
+    if len(results) < size:
+        return results, None
+    return results, query.cursor()
+
+
+def fetch_pages(queries, cursors, size=_PAGE_SIZE):
+    '''
+    fetch_page() of each query of the dict queries, from the cursor of the
+    same name in cursors, starting every query before waiting for any.
+    Returns the pages and the cursors of the next pages by name.
+    '''
+    running = {}
+    for name, query in queries.items():
+        if cursors.get(name):
+            query.with_cursor(cursors[name])
+        running[name] = query.run(limit=size, batch_size=size)
+    pages, next_cursors = {}, {}
+    for name, results in running.items():
+        pages[name] = list(results)
+        next_cursors[name] = len(pages[name]) == size and queries[name].cursor() or None
+    return pages, next_cursors
+
+
+def search_comments(query, model, user=None, public_only=True, cursor=None, limit=_SEARCH_PAGE):
+    '''
+    Finds entities of model (Photo or File) whose comment has words starting
+    with every word of query, using only equality filters, so the datastore
+    answers it by merging the keywords, user and public indexes. Words
+    shorter than _KEYWORD_MIN are ignored: their prefixes are not indexed.
+
+    Returns the results and the cursor of the next page, or None on the last
+    page.
+    '''
+    q = model.all()
+    if user:
+        q.filter('user =', user)
+    if public_only:
+        q.filter('public =', True)
+    terms = [t for t in tokenize(query) if len(t) >= _KEYWORD_MIN]
+    for term in sorted(terms)[:_SEARCH_TERMS]:
+        q.filter('keywords =', term[:_KEYWORD_MAX])
+    return fetch_page(q, cursor, limit)
+
+
+class Availability(db.Model):
+    '''
+    Compact availability of one person: a status code per slot of the
+    appointment (see Appointment.slots), in a single string. Records are
+    children of their appointment, named after the e-mail. Slots past the
+    end of the string have the default status.
+
+    >>> a = Availability(key_name=u'test@example.com', statuses=u'ymn')
+    >>> [a.status(slot, u'maybe') for slot in range(4)]
+    [u'yes', u'maybe', u'no', u'maybe']
+    '''
+    statuses = db.StringProperty(indexed=False, default=u'')
+
+    CODES = {'yes': u'y', 'maybe': u'm', 'no': u'n'}
+    STATUSES = {u'y': u'yes', u'm': u'maybe', u'n': u'no'}
+
+    def status(self, slot, default):
+        if slot < len(self.statuses):
+            return Availability.STATUSES[self.statuses[slot]]
+        return default
+
+    @staticmethod
+    def key_for(appointment_key, email):
+        return db.Key.from_path('Availability', email, parent=appointment_key)
+
+    @staticmethod
+    def set_statuses(appointment, changes):
+        '''
+        Changes statuses, (email, date, status) tuples, with one transactional
+        batch get and put of the records of the people concerned. Returns
+        (email, date, old status, status) for each person with a record.
+        '''
+        emails = list(set([email for email, date, status in changes]))
+        keys = [Availability.key_for(appointment.key(), email) for email in emails]
+        def txn():
+            records = dict(zip(emails, db.get(keys)))
+            applied = []
+            dirty = {}
+            for email, date, status in changes:
+                record = records[email]
+                if record is None:
+                    continue
+                default = appointment.default_status(email)
+                slot = appointment.slot(date)
+                old = record.status(slot, default)
+                applied.append((email, date, old, status))
+                if old != status:
+                    codes = list(record.statuses)
+                    codes.extend([Availability.CODES[default]] * (slot + 1 - len(codes)))
+                    codes[slot] = Availability.CODES[status]
+                    record.statuses = u''.join(codes)
+                    dirty[email] = record
+            db.put(dirty.values())
+            return applied
+        return db.run_in_transaction(txn)
+
+
+class Photo(CachedModel):
     ''' User photo.  '''
     user = db.UserProperty(required=True)
     blob_info = blobstore.BlobReferenceProperty(required=True)
     comment = db.StringProperty(required=False)
     public = db.BooleanProperty(required=True)
     _rotate = db.IntegerProperty(required=False, default=0)
+    keywords = KeywordsProperty()
 
     def _get_rotate(self):
         return self._rotate
@@ -118,13 +1098,882 @@ class Photo(db.Model):
             self._rotate %= 360
     rotate = property(_get_rotate, _set_rotate)
 
+    def to_dict(self):
+        return {
+            'key': str(self.key()),
+            'user': self.user.email(),
+            'comment': self.comment,
+            'public': self.public,
+            'url': '/photos/%s' % self.key(),
+            }
 
-class File(db.Model):
+
+class Rendition(db.Model):
+    '''
+    Rotated and scaled JPEG of a photo. Renditions are children of their
+    photo, named after the rotation angle and maximum width, and are kept in
+    memcache in front of the datastore.
+    '''
+    data = db.BlobProperty(required=True)
+
+    @staticmethod
+    def key_name(photo, width):
+        return '%d:%d' % (photo.rotate or 0, width)
+
+    @staticmethod
+    def cache_key(photo, key_name):
+        return 'rendition:%s:%s' % (photo.key(), key_name)
+
+    @staticmethod
+    def etag(photo, width):
+        ''' Changes with the rotation and the visibility of the photo. '''
+        return '"%s:%s:%d"' % (photo.key(), Rendition.key_name(photo, width), photo.public and 1 or 0)
+
+    @staticmethod
+    def get_data(photo, width):
+        ''' Returns the rendition bytes, transforming the image only once. '''
+        key_name = Rendition.key_name(photo, width)
+        cache_key = Rendition.cache_key(photo, key_name)
+        data = memcache.get(cache_key)
+        if data is None:
+            rendition = Rendition.get_by_key_name(key_name, parent=photo)
+            if rendition:
+                data = rendition.data
+            else:
+                data = Rendition.render(photo, width)
+                Rendition(parent=photo, key_name=key_name, data=db.Blob(data)).put()
+            memcache.set(cache_key, data)
+        return data
+
+    @staticmethod
+    def render(photo, width):
+        ''' Rotates the photo and scales it down when wider than width. '''
+        img = images.Image(blob_key=str(photo.blob_info.key()))
+        img.im_feeling_lucky()
+        img.rotate(photo.rotate or 0)
+        data = img.execute_transforms(output_encoding=images.JPEG)
+        if img.width > width:
+            img = images.Image(data)
+            img.resize(width=width)
+            data = img.execute_transforms(output_encoding=images.JPEG)
+        return data
+
+    @staticmethod
+    def purge(photo):
+        ''' Deletes every rendition of photo, and the sprites showing it. '''
+        keys = Rendition.all(keys_only=True).ancestor(photo).fetch(1000)
+        memcache.delete_multi([Rendition.cache_key(photo, k.name()) for k in keys])
+        db.delete(keys)
+        Sprite.purge(photo)
+
+
+class Sprite(db.Model):
+    '''
+    Contact sheet compositing the thumbnails of a list of photos in a grid of
+    _SPRITE_CELL pixel cells. The key name is a hash of the photo keys,
+    rotations and visibility, so a sprite never changes once stored. offsets
+    is JSON mapping each photo key to [x, y, width, height] in the sprite.
+    public is set when every photo is public, and only then may shared
+    caches keep the sprite. Each photo has a SpriteMember child per sprite
+    showing it, so its sprites are deleted with its renditions.
+    '''
+    data = db.BlobProperty(required=True)
+    offsets = db.TextProperty(required=True)
+    public = db.BooleanProperty(default=False)
+
+    @staticmethod
+    def key_name(photos):
+        ids = ['%s:%d:%d' % (p.key(), p.rotate or 0, p.public and 1 or 0) for p in photos]
+        return hashlib.sha1(','.join(ids)).hexdigest()
+
+    @staticmethod
+    def get_or_build(photos):
+        ''' Returns the sprite of photos from memcache, the datastore or built. '''
+        key_name = Sprite.key_name(photos)
+        cache_key = 'sprite:%s' % key_name
+        sprite = memcache.get(cache_key)
+        if sprite is None:
+            sprite = Sprite.get_by_key_name(key_name)
+            if not sprite:
+                sprite = Sprite.build(key_name, photos)
+                db.put([sprite] + [SpriteMember(parent=p, key_name=key_name) for p in photos])
+            memcache.set(cache_key, sprite)
+        return sprite
+
+    @staticmethod
+    def purge(photo):
+        ''' Deletes the sprites showing photo. '''
+        keys = SpriteMember.all(keys_only=True).ancestor(photo).fetch(1000)
+        names = [k.name() for k in keys]
+        memcache.delete_multi(['sprite:%s' % name for name in names])
+        db.delete(keys + [db.Key.from_path('Sprite', name) for name in names])
+
+    @staticmethod
+    def build(key_name, photos):
+        '''
+        Composites the photo thumbnails. Each cell is rendered from the photo
+        blob with one transform, all of them running concurrently. The images
+        service takes at most images.MAX_COMPOSITES_PER_REQUEST layers per
+        call, so the sheet is built in steps, each one layering new cells over
+        the previous result; intermediate sheets are PNG so that only the last
+        step compresses the cells as JPEG.
+        '''
+        columns = min(len(photos), _SPRITE_COLUMNS)
+        rows = (len(photos) + columns - 1) // columns
+        width, height = columns * _SPRITE_CELL, rows * _SPRITE_CELL
+        rpcs = []
+        for photo in photos:
+            img = images.Image(blob_key=str(photo.blob_info.key()))
+            img.rotate(photo.rotate or 0)
+            img.resize(_SPRITE_CELL, _SPRITE_CELL)
+            img.im_feeling_lucky()
+            rpcs.append(img.execute_transforms_async(output_encoding=images.PNG))
+        offsets = {}
+        layers = []
+        for i, (photo, rpc) in enumerate(zip(photos, rpcs)):
+            thumb = rpc.get_result()
+            x = (i % columns) * _SPRITE_CELL
+            y = (i // columns) * _SPRITE_CELL
+            size = images.Image(thumb)
+            offsets[str(photo.key())] = [x, y, size.width, size.height]
+            layers.append((thumb, x, y, 1.0, images.TOP_LEFT))
+
+        data = None
+        step = images.MAX_COMPOSITES_PER_REQUEST - 1
+        for i in range(0, len(layers), step):
+            inputs = layers[i:i + step]
+            if data is not None:
+                inputs.insert(0, (data, 0, 0, 1.0, images.TOP_LEFT))
+            last = i + step >= len(layers)
+            data = images.composite(inputs, width, height, output_encoding=last and images.JPEG or images.PNG)
+        public = not [p for p in photos if not p.public]
+        return Sprite(key_name=key_name, data=db.Blob(data), offsets=simplejson.dumps(offsets), public=public)
+
+
+class SpriteMember(db.Model):
+    ''' Child of a photo, named after a sprite showing it. '''
+
+
+class File(CachedModel):
     ''' User file. '''
     user = db.UserProperty(required=True)
     blob_info = blobstore.BlobReferenceProperty(required=True)
     comment = db.StringProperty(required=False)
     public = db.BooleanProperty(required=True)
+    keywords = KeywordsProperty()
+
+    def to_dict(self):
+        return {
+            'key': str(self.key()),
+            'user': self.user.email(),
+            'comment': self.comment,
+            'public': self.public,
+            'filename': self.blob_info.filename,
+            'url': '/files/%s/%s' % (self.key(), urllib.quote(self.blob_info.filename.encode('utf-8'))),
+            }
+
+    @staticmethod
+    def load_blob_infos(files):
+        '''
+        Reads the BlobInfo of every file with one batch get, instead of one
+        get per file on the first use of each blob_info.
+        '''
+        files = [f for f in files if isinstance(f, File)]
+        infos = blobstore.BlobInfo.get([File.blob_info.get_value_for_datastore(f) for f in files])
+        for f, info in zip(files, infos):
+            if info:
+                f.blob_info = info
+        return files
+
+
+def put_batched(entities, size=_PUT_BATCH_SIZE):
+    ''' Saves entities using one datastore put per chunk of size entities. '''
+    keys = []
+    for i in range(0, len(entities), size):
+        chunk = entities[i:i + size]
+        stale = [e for e in chunk if isinstance(e, CachedModel) and e.is_saved()]
+        keys.extend(db.put(chunk))
+        if stale:
+            CachedModel.invalidate([e.key() for e in stale])
+    return keys
+
+
+def create_appointments(values_list, keys=None, statuses=None):
+    '''
+    Creates one appointment, together with all its invites, for each dict of
+    Appointment property values in values_list.
+
+    Appointment ids are allocated up front, so appointments and invites are
+    written by the same batched puts: one RPC for the ids and one for each
+    _PUT_BATCH_SIZE entities. keys, when given, are used instead of ids, and
+    statuses, when given, holds for each appointment status lists by e-mail
+    (see Appointment.availability_matrix) replacing the default statuses;
+    they are cleaned first, see Appointment.clean_statuses.
+    '''
+    if not values_list:
+        return []
+    if keys is None:
+        start, end = db.allocate_ids(db.Key.from_path('Appointment', 1), len(values_list))
+        keys = [db.Key.from_path('Appointment', id_) for id_ in range(start, end + 1)]
+    if statuses is None:
+        statuses = [None] * len(values_list)
+    appointments = []
+    entities = []
+    for key, values, status in zip(keys, values_list, statuses):
+        appointment = Appointment(key=key, **values)
+        appointment.date_slots = list(range(len(appointment.date_list)))
+        appointment.next_slot = len(appointment.date_list)
+        records = appointment.make_records()
+        status = appointment.clean_statuses(status or {})
+        appointment.apply_statuses(records, status)
+        appointments.append((appointment, status))
+        entities.append(appointment)
+        entities.extend(records)
+        entities.append(appointment.make_tally(status))
+    put_batched(entities)
+    invalidate_calendars(set(e for a, status in appointments for e in a.people))
+
+    busy = {}
+    for appointment, status in appointments:
+        for email, row in status.items():
+            if 'yes' in row:
+                busy.setdefault(email, []).append(appointment.key())
+    FreeBusy.refresh(busy)
+    return [a for a, status in appointments]
+
+
+def remove_appointment(appointment):
+    '''
+    Removes an appointment with its availability records and tallies. When
+    the records fit in one delete RPC everything goes at once, otherwise the
+    appointment is marked deleted and a background task removes it in
+    batches.
+    '''
+    invalidate_calendars(appointment.people)
+    keys = records_query(appointment.key(), appointment.storage).fetch(_DELETE_BATCH_SIZE + 1)
+    if appointment.storage != 'compact' and len(keys) <= _DELETE_BATCH_SIZE:
+        keys += records_query(appointment.key(), appointment.storage, True).fetch(_DELETE_BATCH_SIZE + 1 - len(keys))
+    if len(keys) <= _DELETE_BATCH_SIZE:
+        db.delete(keys + appointment.tally_keys() + [appointment.key()])
+        CachedModel.invalidate([appointment.key()])
+    else:
+        appointment.deleted = True
+        appointment.put()
+        task_queue.add('/tasks/delete', {
+            'kind': 'Appointment',
+            'key': str(appointment.key()),
+            'storage': appointment.storage,
+            })
+
+
+def records_query(appointment_key, storage, legacy=False):
+    '''
+    Keys-only ancestor query of the invites or Availability records of an
+    appointment. With legacy, query of the invites saved before they were
+    children of their appointment, which is only eventually consistent.
+    '''
+    if storage == 'compact':
+        return Availability.all(keys_only=True).ancestor(appointment_key)
+    if legacy:
+        return Invite.all(keys_only=True).filter('appointment =', appointment_key)
+    return Invite.all(keys_only=True).ancestor(appointment_key)
+
+
+def delete_records_batch(appointment_key, storage, cursor=None):
+    '''
+    Deletes a batch of the availability records of an appointment and
+    returns the cursor of the next batch. Invites saved before they were
+    children of their appointment are deleted last, with cursors prefixed
+    by 'legacy:'. After the last batch the appointment and its tallies are
+    deleted and None is returned.
+    '''
+    legacy = (cursor or '').startswith('legacy:')
+    if legacy:
+        cursor = cursor[len('legacy:'):]
+    keys, cursor = fetch_page(records_query(appointment_key, storage, legacy), cursor, _DELETE_BATCH_SIZE)
+    if not cursor and not legacy and storage != 'compact':
+        legacy = True
+        more, cursor = fetch_page(records_query(appointment_key, storage, legacy), None, _DELETE_BATCH_SIZE)
+        keys += more
+    db.delete(keys)
+    if cursor:
+        return legacy and 'legacy:%s' % cursor or cursor
+    tally_keys = [AvailabilityTally.shard_key(appointment_key, i) for i in range(_TALLY_SHARDS)]
+    db.delete(tally_keys + [appointment_key])
+    CachedModel.invalidate([appointment_key])
+    return None
+
+
+def delete_appointments_batch(email, cursor=None):
+    '''
+    Removes a batch of the appointments owned by email and returns the cursor
+    of the next batch, or None after the last one. Appointments already marked
+    deleted are left to the task removing them.
+    '''
+    q = Appointment.all().filter('email =', email)
+    appointments, cursor = fetch_page(q, cursor, _PAGE_SIZE)
+    for appointment in appointments:
+        if not appointment.deleted:
+            remove_appointment(appointment)
+    return cursor
+
+
+def delete_blobs_batch(model, email, cursor=None):
+    '''
+    Deletes a batch of the photos or files of email, with their blobs and
+    renditions, and returns the cursor of the next batch, or None after the
+    last one. Purging renditions costs a query per photo, so photo batches
+    are smaller.
+    '''
+    q = model.all().filter('user =', users.User(email))
+    size = model is Photo and _PAGE_SIZE or _DELETE_BATCH_SIZE
+    entities, cursor = fetch_page(q, cursor, size)
+    blob_keys = [model.blob_info.get_value_for_datastore(e) for e in entities]
+    if model is Photo:
+        for photo in entities:
+            Rendition.purge(photo)
+    blobstore.delete(blob_keys)
+    db.delete(entities)
+    CachedModel.invalidate([e.key() for e in entities])
+    return cursor
+
+
+class CalendarFeed(db.Model):
+    '''
+    Secret token of the iCalendar feed of a user, named after the e-mail.
+    Calendar clients do not log in, the token in the feed URL stands for the
+    user.
+    '''
+    token = db.StringProperty(required=True)
+
+    @staticmethod
+    def token_for(email):
+        token = memcache.get('icsfeed:%s' % email)
+        if token is None:
+            feed = CalendarFeed.get_by_key_name(email)
+            if feed is None:
+                feed = CalendarFeed.get_or_insert(email, token=hashlib.sha1(os.urandom(20)).hexdigest())
+            token = feed.token
+            memcache.set('icsfeed:%s' % email, token)
+        return token
+
+    @staticmethod
+    def email_for(token):
+        ''' The e-mail of the user of token, or None. '''
+        email = memcache.get('icstoken:%s' % token)
+        if email is None:
+            key = CalendarFeed.all(keys_only=True).filter('token =', token).get()
+            if key is None:
+                return None
+            email = key.name()
+            memcache.set('icstoken:%s' % token, email)
+        return email
+
+
+def invalidate_calendars(emails):
+    '''
+    Drops the cached feeds of emails. As in CachedModel.invalidate, a lock
+    stops a feed rendered before the change from being cached afterwards.
+    '''
+    memcache.set_multi(dict((e, CachedModel._LOCKED) for e in emails), time=_CACHE_LOCK_TIME, key_prefix='ics:')
+
+
+def calendar_events(email):
+    '''
+    Events of the feed of email, a (key, date, description, name, owner
+    e-mail, status of email) tuple for every date of the appointments email
+    owns or is invited to. Statuses are read with one query for invites and
+    one batch get for compact records.
+    '''
+    appointments = {}
+    for query in (Appointment.all().filter('email =', email), Appointment.all().filter('invitee_list =', email)):
+        for appointment in query.run(limit=_CALENDAR_LIMIT, batch_size=_CALENDAR_LIMIT):
+            if not appointment.deleted:
+                appointments[str(appointment.key())] = appointment
+
+    statuses = {}
+    if [a for a in appointments.values() if a.storage != 'compact']:
+        for invite in Invite.all().filter('email =', email).run(batch_size=_QUERY_BATCH_SIZE):
+            statuses[(str(Invite.appointment.get_value_for_datastore(invite)), invite.date)] = invite.status
+    compact = [a for a in appointments.values() if a.storage == 'compact']
+    for appointment, record in zip(compact, db.get([Availability.key_for(a.key(), email) for a in compact])):
+        if record:
+            default = appointment.default_status(email)
+            for date, slot in zip(appointment.date_list, appointment.slots):
+                statuses[(str(appointment.key()), date)] = record.status(slot, default)
+
+    events = []
+    for key in sorted(appointments.keys()):
+        appointment = appointments[key]
+        for date in appointment.date_list:
+            status = statuses.get((key, date), appointment.default_status(email))
+            events.append((key, date, appointment.description, appointment.name, appointment.email, status))
+    return events
+
+
+def ics_text(value):
+    ''' Escapes an iCalendar TEXT value. '''
+    for char, escaped in (('\\', '\\\\'), (';', '\\;'), (',', '\\,'), ('\n', '\\n')):
+        value = value.replace(char, escaped)
+    return value
+
+
+def ics_fold(line):
+    ''' Folds a content line in UTF-8 lines of at most 75 octets, as RFC 5545 asks. '''
+    data = line.encode('utf-8')
+    lines = []
+    while len(data) > 75 - (lines and 1 or 0):
+        # Continuation lines start with a space
+        cut = 75 - (lines and 1 or 0)
+        # Do not split a multibyte character
+        while 0x80 <= ord(data[cut]) < 0xc0:
+            cut -= 1
+        lines.append(data[:cut])
+        data = data[cut:]
+    lines.append(data)
+    return '\r\n '.join(lines)
+
+
+# Status of an invitee, as an iCalendar participation status
+_PARTSTAT = {'yes': 'ACCEPTED', 'maybe': 'TENTATIVE', 'no': 'DECLINED'}
+
+
+def render_calendar(email):
+    '''
+    Returns the ETag and the iCalendar feed of email. The ETag hashes the
+    events, so it only changes with them, not with DTSTAMP.
+    '''
+    events = calendar_events(email)
+    etag = '"%s"' % hashlib.sha1(repr(events)).hexdigest()
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    lines = [
+        u'BEGIN:VCALENDAR',
+        u'VERSION:2.0',
+        u'PRODID:-//%s//EN' % settings.app_config['title'],
+        u'METHOD:PUBLISH',
+        u'X-WR-CALNAME:%s' % ics_text(u'%s (%s)' % (settings.app_config['title'], email)),
+        ]
+    for key, date, description, name, owner, status in events:
+        lines.extend([
+            u'BEGIN:VEVENT',
+            u'UID:%s-%s@%s' % (key, date.strftime('%Y%m%dT%H%M'), os.environ.get('APPLICATION_ID', 'appointment')),
+            u'DTSTAMP:%s' % stamp,
+            u'DTSTART:%s' % date.strftime('%Y%m%dT%H%M%S'),
+            u'DURATION:PT%dM' % _EVENT_MINUTES,
+            u'SUMMARY:%s' % ics_text(description),
+            u'ORGANIZER;CN="%s":mailto:%s' % (name.replace('"', "'"), owner),
+            u'ATTENDEE;PARTSTAT=%s:mailto:%s' % (_PARTSTAT.get(status, 'NEEDS-ACTION'), email),
+            u'STATUS:%s' % (status == 'yes' and 'CONFIRMED' or 'TENTATIVE'),
+            u'TRANSP:%s' % (status == 'no' and 'TRANSPARENT' or 'OPAQUE'),
+            u'END:VEVENT',
+            ])
+    lines.append(u'END:VCALENDAR')
+    return etag, '\r\n'.join([ics_fold(line) for line in lines]) + '\r\n'
+
+
+class FreeBusy(db.Model):
+    '''
+    Busy index of a user, named after the e-mail: the dates the user said
+    yes to, sorted, with the key of their appointment. It is built from the
+    statuses on first use and then updated by each status change. Removed
+    dates and appointments stay in the index until a conflict check finds
+    and drops them.
+    '''
+    starts = db.ListProperty(datetime.datetime, indexed=False)
+    appointments = db.StringListProperty(indexed=False)
+
+    @staticmethod
+    def build(email):
+        ''' Builds and saves the index of email from its statuses. '''
+        busy = sorted([(e[1], e[0]) for e in calendar_events(email) if e[5] == 'yes'])
+        index = FreeBusy(key_name=email, starts=[b[0] for b in busy], appointments=[b[1] for b in busy])
+        index.put()
+        return index
+
+    @staticmethod
+    def update(email, add=(), remove=()):
+        '''
+        Adds and removes (date, appointment key) pairs in the index of email
+        in a transaction. An index not built yet is left to be built on first
+        use, complete.
+        '''
+        def txn():
+            index = FreeBusy.get_by_key_name(email)
+            if index is None:
+                return
+            busy = set(zip(index.starts, index.appointments))
+            busy.difference_update([(d, str(k)) for d, k in remove])
+            busy.update([(d, str(k)) for d, k in add])
+            busy = sorted(busy)
+            index.starts = [b[0] for b in busy]
+            index.appointments = [b[1] for b in busy]
+            index.put()
+        db.run_in_transaction(txn)
+
+    @staticmethod
+    def refresh(keys_by_email):
+        '''
+        Queues the update of the indexes of several users for some of their
+        appointments, {email: [appointment key, ...]}, in tasks of at most
+        _FREEBUSY_TASK_SIZE users. The request only pays one batch get, to
+        skip the indexes not built yet.
+        '''
+        emails = [e for e in keys_by_email if keys_by_email[e]]
+        if not emails:
+            return
+        indexes = db.get([db.Key.from_path('FreeBusy', e) for e in emails])
+        emails = [e for e, index in zip(emails, indexes) if index]
+        for i in range(0, len(emails), _FREEBUSY_TASK_SIZE):
+            chunk = dict((e, [str(k) for k in keys_by_email[e]]) for e in emails[i:i + _FREEBUSY_TASK_SIZE])
+            task_queue.add('/tasks/freebusy', {'keys': simplejson.dumps(chunk)})
+
+    @staticmethod
+    def replace(email, keys, appointments):
+        '''
+        Sets the entries of the appointments with keys in the index of email
+        to the dates email now said yes to, in a transaction. appointments
+        maps keys to appointments, or None for removed ones. Status changes
+        are read again instead of applied, so tasks may run in any order.
+        '''
+        busy = []
+        for key in keys:
+            appointment = appointments.get(key)
+            if appointment and not appointment.deleted:
+                statuses = appointment.statuses_of(email)
+                busy.extend([(d, key) for d, s in zip(appointment.date_list, statuses) if s == 'yes'])
+        def txn():
+            index = FreeBusy.get_by_key_name(email)
+            if index is None:
+                return
+            kept = [b for b in zip(index.starts, index.appointments) if b[1] not in keys]
+            merged = sorted(set(kept + busy))
+            index.starts = [b[0] for b in merged]
+            index.appointments = [b[1] for b in merged]
+            index.put()
+        db.run_in_transaction(txn)
+
+    def busy_near(self, date):
+        '''
+        (date, appointment key) pairs of the index overlapping an appointment
+        at date, found by bisection.
+
+        >>> index = FreeBusy(starts=[datetime.datetime(2012, 12, 21, h) for h in (9, 11, 13)],
+        ...     appointments=['a', 'b', 'c'])
+        >>> [key for start, key in index.busy_near(datetime.datetime(2012, 12, 21, 11, 30))]
+        ['b']
+        '''
+        length = datetime.timedelta(minutes=_EVENT_MINUTES)
+        i = bisect.bisect_right(self.starts, date - length)
+        busy = []
+        while i < len(self.starts) and self.starts[i] < date + length:
+            busy.append((self.starts[i], self.appointments[i]))
+            i += 1
+        return busy
+
+
+def find_conflicts(emails, dates, exclude=None):
+    '''
+    Returns the dates overlapping another appointment each of emails said
+    yes to, as {email: [date, ...]} for the people with a conflict. The
+    busy indexes are read with one batch get, missing ones are built, and
+    the appointments found there are checked with one cached batch get.
+    The dates of the appointment with key exclude do not count.
+    '''
+    emails = list(set(emails))
+    indexes = db.get([db.Key.from_path('FreeBusy', e) for e in emails])
+    candidates = {}
+    for email, index in zip(emails, indexes):
+        if index is None:
+            index = FreeBusy.build(email)
+        for date in dates:
+            for start, key in index.busy_near(date):
+                if key != exclude:
+                    candidates.setdefault(email, []).append((date, start, key))
+
+    keys = list(set([c[2] for found in candidates.values() for c in found]))
+    appointments = dict(zip(keys, keys and Appointment.get(keys) or []))
+    conflicts = {}
+    for email, found in candidates.items():
+        clashes = []
+        stale = []
+        for date, start, key in found:
+            appointment = appointments[key]
+            if appointment and not appointment.deleted and start in appointment.date_list:
+                if date not in clashes:
+                    clashes.append(date)
+            else:
+                stale.append((start, key))
+        if stale:
+            FreeBusy.update(email, remove=stale)
+        if clashes:
+            conflicts[email] = sorted(clashes)
+    return conflicts
+
+
+def export_record(kind, entity, matrix=None):
+    '''
+    Exported dict of entity: to_dict(), with the storage and statuses of
+    appointments, from matrix when given.
+    '''
+    record = entity.to_dict()
+    if kind == 'appointments':
+        record['storage'] = entity.storage
+        record['status'] = (matrix or entity.availability_matrix())['status']
+    return record
+
+
+def csv_rows(kind, record):
+    '''
+    CSV rows of an exported record, with the columns of _EXPORT_COLUMNS. An
+    appointment has a row per person and date, or per person without dates.
+
+    >>> record = {'key': 'k', 'description': u'Party', 'name': u'John',
+    ...     'email': u'john@example.com', 'storage': 'invites',
+    ...     'invitees': [u'test@example.com'], 'dates': ['2012-12-21 12:00'],
+    ...     'status': {u'john@example.com': ['yes'], u'test@example.com': ['no']}}
+    >>> for row in csv_rows('appointments', record):
+    ...     print(row[5:])
+    ['2012-12-21 12:00', 'john@example.com', 'yes']
+    ['2012-12-21 12:00', 'test@example.com', 'no']
+    '''
+    def encode(value):
+        if value is None:
+            return ''
+        return unicode(value).encode('utf-8')
+    if kind != 'appointments':
+        return [[encode(record[c]) for c in _EXPORT_COLUMNS[kind]]]
+    people = [record['email']] + [e for e in record['invitees'] if e != record['email']]
+    head = [encode(record[c]) for c in _EXPORT_COLUMNS[kind][:5]]
+    rows = []
+    for email in people:
+        statuses = record['status'].get(email) or [None] * len(record['dates'])
+        for date, status in zip(record['dates'], statuses):
+            rows.append(head + [date, encode(email), encode(status)])
+        if not record['dates']:
+            rows.append(head + ['', encode(email), ''])
+    return rows
+
+
+def read_export(data, format):
+    '''
+    Parses an appointments export in format (csv or ndjson), yielding an
+    exported record for each appointment, or None for an unreadable NDJSON
+    line. The rows of a CSV appointment must be consecutive.
+    '''
+    if format != 'csv':
+        for line in StringIO(data):
+            if line.strip():
+                try:
+                    yield simplejson.loads(line)
+                except ValueError:
+                    yield None
+        return
+    reader = csv.reader(StringIO(data))
+    columns = reader.next()
+    rows = (dict(zip(columns, [c.decode('utf-8') for c in row])) for row in reader)
+    for key, group in itertools.groupby(rows, lambda row: row.get('key')):
+        record = None
+        for row in group:
+            if record is None:
+                record = dict((c, row.get(c)) for c in _EXPORT_COLUMNS['appointments'][:5])
+                record.update({'invitees': [], 'dates': [], 'status': {}})
+            email, date = row.get('invitee'), row.get('date')
+            if email and email != record['email'] and email not in record['invitees']:
+                record['invitees'].append(email)
+            if date and date not in record['dates']:
+                record['dates'].append(date)
+            if email and date:
+                status = record['status'].setdefault(email, [])
+                status.extend([None] * (record['dates'].index(date) + 1 - len(status)))
+                status[record['dates'].index(date)] = row.get('status')
+        yield record
+
+
+def import_appointment(record):
+    '''
+    Validates an exported appointment record. Returns the key it is imported
+    under, named after the exported key, its Appointment property values and
+    its status lists by e-mail. Raises ValueError for an invalid record.
+    '''
+    try:
+        values = dict(
+            description=record['description'],
+            invitee_list=[db.Email(i.strip()) for i in record['invitees']],
+            date_list=[datetime.datetime.strptime(d, settings.DATETIME_FORMAT) for d in record['dates']],
+            name=record['name'],
+            email=db.Email(record['email'].strip()),
+            storage=record.get('storage') in _STORAGE_MODES and record['storage'] or _DEFAULT_STORAGE,
+            )
+        key = db.Key.from_path('Appointment', 'import:%s' % record['key'])
+        status = dict((e, list(row)) for e, row in (record.get('status') or {}).items() if isinstance(row, list))
+    except (KeyError, TypeError, AttributeError, db.BadValueError, db.BadArgumentError):
+        raise ValueError('invalid appointment record')
+    if not values['description'] or not values['name'] or not values['email']:
+        raise ValueError('invalid appointment record')
+    return key, values, status
+
+
+def import_appointments(batch):
+    '''
+    Creates the appointments of batch, tuples returned by
+    import_appointment(), that do not exist yet. Returns how many it created.
+    '''
+    existing = set([a.key() for a in db.get([key for key, values, status in batch]) if a])
+    new = dict((key, (values, status)) for key, values, status in batch if key not in existing)
+    keys = new.keys()
+    create_appointments([new[k][0] for k in keys], keys, [new[k][1] for k in keys])
+    return len(keys)
+
+
+_templates = {}
+_template_libraries = []
+
+def get_template(template_name):
+    '''
+    Returns the compiled template, loading it once per process. In debug mode
+    templates are loaded again on each call, so edits show up at once.
+    '''
+    if not _template_libraries:
+        # Add custom Django template filters/tags
+        template.register_template_library('templatetags')
+        _template_libraries.append('templatetags')
+    if _DEBUG or template_name not in _templates:
+        directory = os.path.dirname(__file__)
+        path = os.path.join(directory, 'template', template_name)
+        _templates[template_name] = template.load(path, debug=_DEBUG)
+    return _templates[template_name]
+
+
+class AuthURL(object):
+    '''
+    Login or logout URL for a template. The users service is only called when
+    the template writes the URL, and once per instance for each destination.
+    '''
+    _cache = {}
+
+    def __init__(self, create_url, dest_url):
+        self.create_url = create_url
+        self.dest_url = dest_url
+
+    def __unicode__(self):
+        key = (self.create_url.__name__, self.dest_url)
+        if key not in AuthURL._cache:
+            if len(AuthURL._cache) >= _AUTH_URL_CACHE_SIZE:
+                AuthURL._cache.clear()
+            AuthURL._cache[key] = self.create_url(self.dest_url)
+        return AuthURL._cache[key]
+
+    def __str__(self):
+        return self.__unicode__().encode('utf-8')
+
+
+class TaskQueue(object):
+    '''
+    Adds tasks to an App Engine task queue. Tasks are held until flush(),
+    called once the request is handled, adds them with one RPC per
+    taskqueue.MAX_TASKS_PER_ADD tasks.
+    '''
+    def __init__(self, name='default'):
+        self.name = name
+        self.pending = []
+
+    def add(self, url, params, countdown=0):
+        self.pending.append(taskqueue.Task(url=url, params=params, countdown=countdown))
+
+    def flush(self):
+        tasks, self.pending = self.pending, []
+        queue = taskqueue.Queue(self.name)
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+class LocalQueue(object):
+    '''
+    In-process stand-in for TaskQueue, used by tests. Tasks are only recorded
+    until run() posts them to a WSGI application. As in the task queue, a task
+    answered with an error status is run again, up to max_retries times.
+
+    >>> queue = LocalQueue()
+    >>> queue.add('/tasks/mail', {'key': 'abc', 'invitee': ['test@example.com']})
+    >>> [url for url, params, retries in queue.tasks]
+    ['/tasks/mail']
+    '''
+    def __init__(self, max_retries=3):
+        self.max_retries = max_retries
+        self.tasks = []
+
+    def add(self, url, params, countdown=0):
+        self.tasks.append((url, params, 0))
+
+    def flush(self):
+        pass
+
+    def run(self, application):
+        ''' Runs queued tasks, including the ones they add, until none is left. '''
+        while self.tasks:
+            url, params, retries = self.tasks.pop(0)
+            status = self._post(application, url, params)
+            if not 200 <= status < 300 and retries < self.max_retries:
+                self.tasks.append((url, params, retries + 1))
+
+    def _post(self, application, url, params):
+        status, headers, body = call_application(application, 'POST', url, params)
+        return status
+
+
+def call_application(application, method, url, params=None, environ=None):
+    '''
+    Calls a WSGI application in process, like a form submit (POST) or a link
+    (any other method) would, and returns the status code, the headers and
+    the body of its answer. environ overrides the default CGI variables.
+    '''
+    data = urllib.urlencode(params or {}, True)
+    path, query = (url.split('?', 1) + [''])[:2]
+    body = ''
+    if method == 'POST':
+        body = data
+    elif data:
+        query = query and '%s&%s' % (query, data) or data
+    request_environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(body),
+        'wsgi.errors': StringIO(),
+        }
+    request_environ.update(environ or {})
+    answer = []
+    def start_response(status_line, headers, exc_info=None):
+        answer.append((int(status_line.split()[0]), headers))
+    body = ''.join(application(request_environ, start_response))
+    status, headers = answer[0]
+    return status, headers, body
+
+
+# Queue used for background work, flushed after each request by flush_tasks;
+# tests replace it with a LocalQueue
+task_queue = TaskQueue()
+
+
+def queue_appointment_mails(appointment, host):
+    '''
+    Queues the overview e-mail for the owner and the invitations, split into
+    tasks of _MAIL_BATCH_SIZE invitees that the task queue runs in parallel.
+    '''
+    key = str(appointment.key())
+    task_queue.add('/tasks/mail', {'key': key, 'host': host, 'overview': '1'})
+    invitees = appointment.invitee_list
+    for i in range(0, len(invitees), _MAIL_BATCH_SIZE):
+        task_queue.add('/tasks/mail', {
+            'key': key,
+            'host': host,
+            'invitee': invitees[i:i + _MAIL_BATCH_SIZE],
+            })
 
 
 # Login required decorator
@@ -152,32 +2001,134 @@ def admin_required(method):
 class BaseRequestHandler(webapp.RequestHandler):
     ''' Suplies a common template generation method. '''
     def generate(self, template_name, template_values={}):
-        lang = self.request.get('lang')
-        translation.activate(lang)
+        # Django keeps one translation per language, activation only selects it
+        lang = self.request.get('lang') or django_settings.LANGUAGE_CODE
+        if lang != translation.get_language():
+            translation.activate(lang)
 
         values = {
             'request': self.request,
             'current_user': self.current_user,
-            'login_url': users.create_login_url(self.request.uri),
-            'logout_url': users.create_logout_url('http://%s/' % self.request.host),
+            'login_url': AuthURL(users.create_login_url, self.request.uri),
+            'logout_url': AuthURL(users.create_logout_url, 'http://%s/' % self.request.host),
             'settings': settings,
         }
 
         values.update(template_values)
-        directory = os.path.dirname(__file__)
-        path = os.path.join(directory, 'template', template_name)
-        self.response.out.write(template.render(path, values, debug=_DEBUG))
+        self.response.out.write(get_template(template_name).render(Context(values)))
 
     def error(self, code):
         super(BaseRequestHandler, self).error(code)
         self.response.out.write(self.response.http_status_message(code))
 
+    def write_json(self, value):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(simplejson.dumps(value))
+
+    def paginate(self, query):
+        '''
+        Returns the page of query results selected by the cursor and size
+        request parameters, and the URL of the next page or None.
+        '''
+        try:
+            size = int(self.request.get('size', _PAGE_SIZE))
+        except ValueError:
+            size = _PAGE_SIZE
+        size = max(1, min(size, _MAX_PAGE_SIZE))
+        results, cursor = fetch_page(query, self.request.get('cursor'), size)
+        next_url = None
+        if cursor:
+            params = {'cursor': cursor, 'size': size}
+            for name in ('format', 'when'):
+                if self.request.get(name):
+                    params[name] = self.request.get(name)
+            next_url = '%s?%s' % (self.request.path, urllib.urlencode(params))
+        return results, next_url
+
+    def generate_page(self, template_name, name, query):
+        '''
+        Renders a page of query results as template variable name, or as
+        JSON with format=json. Appointments being deleted are left out.
+        '''
+        try:
+            results, next_url = self.paginate(query)
+        except (db.BadRequestError, db.BadValueError):
+            return self.error(400)
+        results = [r for r in results if not getattr(r, 'deleted', False)]
+        File.load_blob_infos(results)
+        if self.request.get('format') == 'json':
+            self.write_json({name: [r.to_dict() for r in results], 'next': next_url})
+        else:
+            self.generate(template_name, {name: results, 'next_url': next_url})
+
+    def write_rendition(self, photo, width):
+        '''
+        Writes a cached photo rendition, or 304 if the client has it. The URL
+        is the same whatever the rotation or visibility of the photo, so
+        caches revalidate on each use, which usually costs a 304.
+        '''
+        etag = Rendition.etag(photo, width)
+        if photo.public:
+            self.response.headers['Cache-Control'] = 'public, no-cache'
+        else:
+            self.response.headers['Cache-Control'] = 'private, no-cache'
+        self.response.headers['ETag'] = etag
+        if etag in self.request.headers.get('If-None-Match', ''):
+            self.response.set_status(304)
+            return
+        self.response.headers['Content-Type'] = 'image/jpeg'
+        self.response.out.write(Rendition.get_data(photo, width))
+
     @property
     def current_user(self):
-        user = users.get_current_user()
-        if user:
-            user.administrator = users.is_current_user_admin()
-        return user
+        ''' The logged user, looked up once per request. '''
+        if not hasattr(self, '_current_user'):
+            user = users.get_current_user()
+            if user:
+                user.administrator = users.is_current_user_admin()
+            self._current_user = user
+        return self._current_user
+
+
+class BlobDownloadHandler(blobstore_handlers.BlobstoreDownloadHandler):
+    '''
+    Serves the blob of a Photo or File. Blobs are immutable, so a blob key is
+    a strong ETag and the creation time its Last-Modified: revalidations get
+    a 304 and Range requests are served from the blobstore.
+    '''
+    def send_owned_blob(self, entity):
+        ''' Sends the blob of entity, or 404 when it is private to another user. '''
+        if not entity.public and entity.user != users.get_current_user():
+            return self.error(404)
+        blob_info = blobstore.BlobInfo.get(entity.blob_info.key())
+        if not blob_info:
+            return self.error(404)
+
+        etag = '"%s"' % blob_info.key()
+        last_modified = blob_info.creation.strftime('%a, %d %b %Y %H:%M:%S GMT')
+        if entity.public:
+            self.response.headers['Cache-Control'] = 'public, max-age=%d' % _BLOB_MAX_AGE
+        else:
+            self.response.headers['Cache-Control'] = 'private, max-age=%d' % _BLOB_MAX_AGE
+        self.response.headers['ETag'] = etag
+        self.response.headers['Last-Modified'] = last_modified
+        self.response.headers['Accept-Ranges'] = 'bytes'
+        if self.not_modified(etag, blob_info.creation):
+            self.response.set_status(304)
+            return
+
+        # A Range applies only to the version named by If-Range, if any
+        if_range = self.request.headers.get('If-Range')
+        use_range = not if_range or if_range in (etag, last_modified)
+        self.send_blob(blob_info, use_range=use_range)
+
+    def not_modified(self, etag, modified):
+        ''' Whether the client copy, per If-None-Match or If-Modified-Since, is current. '''
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match:
+            return if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]
+        since = parsedate(self.request.headers.get('If-Modified-Since', ''))
+        return bool(since) and modified.replace(microsecond=0) <= datetime.datetime(*since[:6])
 
 
 class HomeHandler(BaseRequestHandler):
@@ -216,72 +2167,290 @@ class NewAppointmentHandler(BaseRequestHandler):
         date_list = [datetime.datetime.strptime(d, settings.DATETIME_FORMAT) for d in datetimes]
         name = self.current_user.nickname()
         email = self.current_user.email()
+        storage = self.request.get('storage')
+        if storage not in _STORAGE_MODES:
+            storage = _DEFAULT_STORAGE
 
-        # Save appointment
-        appointment = Appointment(
+        # Save appointment and invites
+        appointment, = create_appointments([dict(
             description=description,
             invitee_list=invitee_list,
             date_list=date_list,
             name=name,
             email=email,
-            )
-        appointment.put()
+            storage=storage,
+            )])
 
-        # Save invitees
-        for date in date_list:
-            owner = Invite(
-                email=appointment.email,
-                date=date,
-                appointment=appointment,
-                status='yes'
-                )
-            owner.put()
+        queue_appointment_mails(appointment, self.request.host)
 
-            for invitee in invitee_list:
-                i = Invite(
-                    email=invitee,
-                    date=date,
-                    appointment=appointment,
-                    status='maybe'
-                    )
-                i.put()
-
-        # Send the overview e-mail
-        msg = mail.EmailMessage()
-        msg.subject = 'Overview: %s' % appointment.description
-        msg.sender = settings.app_config['email']
-        msg.to = appointment.email
-        directory = os.path.dirname(__file__)
-        path = os.path.join(directory, 'template', 'overview.html')
-        msg.html = template.render(path, {
+        self.redirect('/appointment?key=%s&user=%s' % (appointment.key(), appointment.email))
+
+
+class BulkAppointmentHandler(BaseRequestHandler):
+    ''' Creates many appointments in one request. '''
+    @login_required
+    def post(self):
+        '''
+        Expects a JSON body like:
+
+            {"appointments": [{"description": "Party",
+                               "invitees": ["test@example.com"],
+                               "dates": ["2012-12-21 12:00"],
+                               "storage": "compact"}]}
+
+        and answers with the keys of the created appointments. storage is
+        optional, see _STORAGE_MODES. Requests with more than _BULK_LIMIT
+        appointments or _BULK_RECORD_LIMIT person and date pairs in total
+        are refused with 413.
+        '''
+        name = self.current_user.nickname()
+        email = self.current_user.email()
+        try:
+            data = simplejson.loads(self.request.body)['appointments']
+            if len(data) > _BULK_LIMIT:
+                return self.error(413)
+            values_list = [dict(
+                description=a['description'],
+                invitee_list=[db.Email(i.strip()) for i in a['invitees']],
+                date_list=[datetime.datetime.strptime(d, settings.DATETIME_FORMAT) for d in a['dates']],
+                name=name,
+                email=email,
+                storage=a.get('storage', _DEFAULT_STORAGE),
+                ) for a in data]
+        except (ValueError, KeyError, TypeError, AttributeError, db.BadValueError):
+            return self.error(400)
+        records = sum([(len(v['invitee_list']) + 1) * len(v['date_list']) for v in values_list])
+        if records > _BULK_RECORD_LIMIT:
+            return self.error(413)
+        try:
+            appointments = create_appointments(values_list)
+        except db.BadValueError:
+            return self.error(400)
+
+        for appointment in appointments:
+            queue_appointment_mails(appointment, self.request.host)
+
+        self.write_json({'keys': [str(a.key()) for a in appointments]})
+
+
+class FreeBusyHandler(BaseRequestHandler):
+    @login_required
+    def get(self):
+        '''
+        Answers which of the proposed dates (date parameters) conflict with
+        an appointment the invitees (comma separated) said yes to, ignoring
+        the appointment key if given:
+
+            {"conflicts": {"test@example.com": ["2012-12-21 12:00"]}}
+        '''
+        invitees = [i.strip() for i in self.request.get('invitees').split(',') if i.strip()]
+        if len(invitees) > _FREEBUSY_LIMIT:
+            return self.error(413)
+        try:
+            dates = [datetime.datetime.strptime(d, settings.DATETIME_FORMAT) for d in self.request.get_all('date')]
+        except ValueError:
+            return self.error(400)
+        conflicts = find_conflicts(invitees, dates, self.request.get('key') or None)
+        self.write_json({'conflicts': dict((email, [d.strftime(settings.DATETIME_FORMAT) for d in found])
+                                           for email, found in conflicts.items())})
+
+
+class CalendarHandler(webapp.RequestHandler):
+    def get(self, token):
+        '''
+        Serves the iCalendar feed of the user of token from memcache, so
+        that polls, and above all the 304 answers to them, rarely read the
+        datastore.
+        '''
+        email = CalendarFeed.email_for(token)
+        if not email:
+            return self.error(404)
+        cache_key = 'ics:%s' % email
+        feed = memcache.get(cache_key)
+        if feed is None or feed == CachedModel._LOCKED:
+            locked = feed is not None
+            feed = render_calendar(email)
+            if not locked:
+                memcache.add(cache_key, feed, time=_CALENDAR_CACHE_TIME)
+        etag, body = feed
+
+        self.response.headers['Cache-Control'] = 'private, max-age=%d' % _CALENDAR_MAX_AGE
+        self.response.headers['ETag'] = etag
+        if etag in self.request.headers.get('If-None-Match', ''):
+            self.response.set_status(304)
+            return
+        self.response.headers['Content-Type'] = 'text/calendar; charset=utf-8'
+        self.response.out.write(body)
+
+
+class ExportHandler(BaseRequestHandler):
+    @login_required
+    def get(self):
+        '''
+        Exports kind (appointments, photos or files) as format, ndjson (the
+        default) or csv: everything for administrators, their own data for
+        other users. Entities are read _EXPORT_BATCH_SIZE at a time, with the
+        status queries of a batch of appointments running concurrently, and
+        at most _EXPORT_LIMIT (_EXPORT_APPOINTMENT_LIMIT for appointments)
+        are written; the Link header then has the URL of the rest.
+        '''
+        kind = self.request.get('kind', 'appointments')
+        format = self.request.get('format', 'ndjson')
+        if kind not in _EXPORT_COLUMNS or format not in ('csv', 'ndjson'):
+            return self.error(400)
+        query = {'appointments': Appointment, 'photos': Photo, 'files': File}[kind].all()
+        if not self.current_user.administrator:
+            if kind == 'appointments':
+                query.filter('email =', self.current_user.email())
+            else:
+                query.filter('user =', self.current_user)
+
+        if format == 'csv':
+            self.response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+            writer = csv.writer(self.response.out)
+            writer.writerow(_EXPORT_COLUMNS[kind])
+        else:
+            self.response.headers['Content-Type'] = 'application/x-ndjson; charset=utf-8'
+        self.response.headers['Content-Disposition'] = 'attachment; filename=%s.%s' % (kind, format)
+
+        limit = kind == 'appointments' and _EXPORT_APPOINTMENT_LIMIT or _EXPORT_LIMIT
+        cursor = self.request.get('cursor')
+        written = 0
+        try:
+            while written < limit:
+                entities, cursor = fetch_page(query, cursor, _EXPORT_BATCH_SIZE)
+                matrices = [None] * len(entities)
+                if kind == 'files':
+                    File.load_blob_infos(entities)
+                elif kind == 'appointments':
+                    entities = [e for e in entities if not e.deleted]
+                    matrices = Appointment.availability_matrices(entities)
+                for entity, matrix in zip(entities, matrices):
+                    record = export_record(kind, entity, matrix)
+                    if format == 'csv':
+                        writer.writerows(csv_rows(kind, record))
+                    else:
+                        self.response.out.write(simplejson.dumps(record) + '\n')
+                written += len(entities)
+                if not cursor:
+                    break
+        except (db.BadRequestError, db.BadValueError):
+            self.response.clear()
+            return self.error(400)
+        if cursor:
+            next_url = '%s?%s' % (self.request.path, urllib.urlencode({'kind': kind, 'format': format, 'cursor': cursor}))
+            self.response.headers['Link'] = '<%s>; rel="next"' % next_url
+
+
+class ImportHandler(BaseRequestHandler):
+    @admin_required
+    def post(self):
+        '''
+        Imports the appointments of an export, in format csv or ndjson, posted
+        as request body: at most _IMPORT_LIMIT records from record number
+        start, written in batches. Appointments are named after their
+        exported key and existing ones are skipped, so an interrupted import
+        resumes by posting the body again. No invitation is sent. Answers:
+
+            {"imported": 10, "skipped": 0, "errors": [3], "next": 500}
+
+        errors lists the numbers of invalid records; next is the start of the
+        following request, or null when the import is complete.
+        '''
+        try:
+            start = max(0, int(self.request.get('start', 0)))
+        except ValueError:
+            return self.error(400)
+        result = {'imported': 0, 'skipped': 0, 'errors': [], 'next': None}
+        batch = []
+        records = read_export(self.request.body, self.request.get('format'))
+        try:
+            for i, record in enumerate(records):
+                if i < start:
+                    continue
+                if i == start + _IMPORT_LIMIT:
+                    result['next'] = i
+                    break
+                try:
+                    batch.append(import_appointment(record))
+                except ValueError:
+                    result['errors'].append(i)
+                if len(batch) == _IMPORT_BATCH_SIZE:
+                    imported = import_appointments(batch)
+                    result['imported'] += imported
+                    result['skipped'] += len(batch) - imported
+                    batch = []
+        except csv.Error:
+            return self.error(400)
+        if batch:
+            imported = import_appointments(batch)
+            result['imported'] += imported
+            result['skipped'] += len(batch) - imported
+        self.write_json(result)
+
+
+class MailTaskHandler(webapp.RequestHandler):
+    ''' Task queue worker sending appointment e-mails. '''
+    def post(self):
+        '''
+        Sends the overview e-mail or the invitations of one batch. The
+        invitation template is rendered with a shared context where only the
+        invitee changes. Invitees whose message failed are queued again.
+        '''
+        appointment = Appointment.get(self.request.get('key'))
+        if not appointment:
+            return
+        host = self.request.get('host')
+        retries = int(self.request.get('retries', 0))
+        context = Context({
             'appointment': appointment,
+            'host': host,
             'settings': settings,
-            'request': self.request})
-        msg.send()
+            })
 
-        # Send an email invitation for each invitee
-        for invitee in appointment.invitee_list:
+        if self.request.get('overview'):
             msg = mail.EmailMessage()
-            msg.subject = 'Invitation: %s' % appointment.description
+            msg.subject = 'Overview: %s' % appointment.description
             msg.sender = settings.app_config['email']
-            msg.to = invitee
-            directory = os.path.dirname(__file__)
-            path = os.path.join(directory, 'template', 'invitation.html')
-            msg.html = template.render(path, {
-                'appointment': appointment,
-                'invitee': invitee,
-                'settings': settings,
-                'request': self.request})
+            msg.to = appointment.email
+            msg.html = get_template('overview.html').render(context)
             msg.send()
-
-        self.redirect('/appointment?key=%s&user=%s' % (appointment.key(), appointment.email))
+            return
+
+        invitation = get_template('invitation.html')
+        failed = []
+        for invitee in self.request.get_all('invitee'):
+            context.push()
+            context['invitee'] = invitee
+            try:
+                msg = mail.EmailMessage()
+                msg.subject = 'Invitation: %s' % appointment.description
+                msg.sender = settings.app_config['email']
+                msg.to = invitee
+                msg.html = invitation.render(context)
+                msg.send()
+            except Exception:
+                logging.exception('Invitation to %s failed', invitee)
+                failed.append(invitee)
+            context.pop()
+
+        if failed:
+            if retries < _MAIL_RETRIES:
+                task_queue.add('/tasks/mail', {
+                    'key': str(appointment.key()),
+                    'host': host,
+                    'invitee': failed,
+                    'retries': retries + 1,
+                    }, countdown=2 ** retries * 10)
+            else:
+                logging.error('Giving up invitations to %s', ', '.join(failed))
 
 
 class PublicImagesHandler(BaseRequestHandler):
     def get(self):
         '''Returns a photo galery with all public photos.'''
         photos = Photo.all().filter('public =', True)
-        self.generate('publicphotos.html', {'photos': photos})
+        self.generate_page('publicphotos.html', 'photos', photos)
 
 
 class AppointmentHandler(BaseRequestHandler):
@@ -289,17 +2458,31 @@ class AppointmentHandler(BaseRequestHandler):
         key = self.request.get('key')
         user = self.request.get('user')
         appointment = Appointment.get(key)
-        if not appointment:
+        if not appointment or appointment.deleted:
             return self.error(404)
-        invitees = Invite.all().filter('appointment =', appointment)
-        self.generate('appointment.html', {'appointment': appointment, 'invitees': invitees, 'user': user})
+        matrix = appointment.availability_matrix()
+        matrix_json = simplejson.dumps(matrix).replace('</', '<\\/')
+        conflicts = []
+        if user in appointment.people:
+            conflicts = find_conflicts([user], appointment.date_list, str(appointment.key())).get(user, [])
+        conflicts_json = simplejson.dumps([d.strftime(settings.DATETIME_FORMAT) for d in conflicts])
+        self.generate('appointment.html', {
+            'appointment': appointment,
+            'matrix_json': matrix_json,
+            'conflicts_json': conflicts_json,
+            'user': user,
+            })
 
 
 class AppointmentsHandler(BaseRequestHandler):
     @admin_required
     def get(self):
-        appointments = Appointment.all().order('-date_list')
-        self.generate('appointment_list.html', {'appointments': appointments})
+        ''' Lists upcoming appointments, or past ones with when=past. '''
+        if self.request.get('when') == 'past':
+            appointments = Appointment.past(Appointment.all())
+        else:
+            appointments = Appointment.upcoming(Appointment.all())
+        self.generate_page('appointment_list.html', 'appointments', appointments)
 
 class AvailabilityHandler(BaseRequestHandler):
     def get(self):
@@ -310,9 +2493,9 @@ class AvailabilityHandler(BaseRequestHandler):
         d = self.request.get('date')
         date = datetime.datetime.strptime(d, settings.DATETIME_FORMAT)
         appointment = Appointment.get(key)
-        if not appointment:
+        if not appointment or appointment.deleted:
             return self.error(404)
-        invitee = Invite.all().filter('email =', email).filter('date =', date).filter('appointment =', appointment).get()
+        invitee = appointment.get_invite(email, date)
         if not invitee:
             return self.error(404)
         if user == invitee.email:
@@ -328,31 +2511,178 @@ class AvailabilityHandler(BaseRequestHandler):
         date = datetime.datetime.strptime(d, settings.DATETIME_FORMAT)
         availability = self.request.get('availability')
         appointment = Appointment.get(key)
-        if not appointment:
+        if not appointment or appointment.deleted:
             return self.error(404)
-        invitee = Invite.all().filter('email =', user).filter('date =', date).filter('appointment =', appointment).get()
-        if not invitee:
+        if availability not in _STATUSES:
+            return self.error(400)
+        old = appointment.set_status(user, date, availability)
+        if old is None:
             return self.error(404)
-        invitee.status = availability
-        invitee.put()
+
+
+class BulkAvailabilityHandler(BaseRequestHandler):
+    def post(self):
+        '''
+        Changes many statuses of an appointment in one batched transaction.
+        Expects a JSON body with the row of one invitee, who is trusted like
+        in AvailabilityHandler:
+
+            {"key": "...", "user": "test@example.com",
+             "statuses": {"2012-12-21 12:00": "yes", "2012-12-22 12:00": "no"}}
+
+        or, from the logged owner of the appointment, rows by e-mail:
+
+            {"key": "...", "matrix": {"test@example.com": {"2012-12-21 12:00": "yes"}}}
+
+        and answers with the changes applied and the updated ranking:
+
+            {"applied": [{"email": "test@example.com", "date": "2012-12-21 12:00", "status": "yes"}],
+             "ranking": [{"date": "2012-12-21 12:00", "yes": 2, "maybe": 0, "no": 0}]}
+        '''
+        try:
+            data = simplejson.loads(self.request.body)
+            appointment = Appointment.get(data['key'])
+            if 'matrix' in data:
+                rows = data['matrix']
+            else:
+                rows = {data['user']: data['statuses']}
+            changes = []
+            for email, row in rows.items():
+                for d, status in row.items():
+                    changes.append((email, datetime.datetime.strptime(d, settings.DATETIME_FORMAT), status))
+        except (ValueError, KeyError, TypeError, AttributeError, db.BadKeyError):
+            return self.error(400)
+        if not appointment or appointment.deleted:
+            return self.error(404)
+        if 'matrix' in data and (not self.current_user or self.current_user.email() != appointment.email):
+            return self.error(405)
+        if len(changes) > _BULK_STATUS_LIMIT:
+            return self.error(413)
+        if [c for c in changes if c[2] not in _STATUSES]:
+            return self.error(400)
+
+        applied = appointment.set_statuses(changes)
+        self.write_json({
+            'applied': [{
+                'email': email,
+                'date': date.strftime(settings.DATETIME_FORMAT),
+                'status': status,
+                } for email, date, old, status in applied],
+            'ranking': appointment.ranked_dates(),
+            })
+
+
+class AppointmentDatesHandler(BaseRequestHandler):
+    @login_required
+    def post(self):
+        ''' Adds (action=add) or removes (action=remove) a proposed date. '''
+        appointment = Appointment.get(self.request.get('key'))
+        if not appointment or appointment.deleted:
+            return self.error(404)
+        if appointment.email != self.current_user.email():
+            return self.error(405)
+        try:
+            date = datetime.datetime.strptime(self.request.get('date'), settings.DATETIME_FORMAT)
+        except ValueError:
+            return self.error(400)
+
+        action = self.request.get('action')
+        if action == 'add':
+            appointment.add_date(date)
+        elif action == 'remove':
+            appointment.remove_date(date)
+        else:
+            return self.error(400)
+
+
+class AvailabilityMatrixHandler(BaseRequestHandler):
+    def get(self):
+        '''
+        Returns the people x dates availability of an appointment, as JSON or,
+        with format=html, as a rendered table.
+        '''
+        appointment = Appointment.get(self.request.get('key'))
+        if not appointment or appointment.deleted:
+            return self.error(404)
+        matrix = appointment.availability_matrix()
+        if self.request.get('format') == 'html':
+            rows = [(email, matrix['status'][email]) for email in matrix['people']]
+            self.generate('availabilitymatrix.html', {'dates': matrix['dates'], 'rows': rows})
+        else:
+            self.write_json(matrix)
+
+
+class RankingHandler(BaseRequestHandler):
+    def get(self):
+        ''' Returns the appointment dates ranked by availability, as JSON. '''
+        appointment = Appointment.get(self.request.get('key'))
+        if not appointment or appointment.deleted:
+            return self.error(404)
+        self.write_json(appointment.ranked_dates())
 
 
 class AppointmentRemoveHandler(BaseRequestHandler):
+    @login_required
     def post(self):
         '''Removes an appointment.'''
         key = self.request.get('key');
         appointment = Appointment.get(key)
-        if not appointment:
+        if not appointment or appointment.deleted:
             return self.error(404)
 
-        if appointment.email == self.current_user.email:
+        if appointment.email != self.current_user.email():
             return self.error(405)
 
-        invitees = Invite.all().filter('appointment =', appointment)
-        for invitee in invitees:
-            invitee.delete()
+        remove_appointment(appointment)
+
+
+class AccountCleanupHandler(BaseRequestHandler):
+    @login_required
+    def post(self):
+        '''
+        Removes, in the background, all appointments, photos and files of the
+        user. The confirm parameter must repeat the user's e-mail.
+        '''
+        email = self.current_user.email()
+        if self.request.get('confirm') != email:
+            return self.error(400)
+        for kind in ('Appointment', 'Photo', 'File'):
+            task_queue.add('/tasks/delete', {'kind': kind, 'user': email})
+
 
-        appointment.delete()
+class CascadeDeleteTaskHandler(webapp.RequestHandler):
+    '''
+    Task queue worker removing data in batches. Each task removes one batch
+    and queues the next one with a cursor, so an interrupted removal resumes
+    where it stopped. Parameters:
+
+    * kind=Appointment, key, storage: the invites or Availability records
+      of the appointment, then the appointment itself and its tallies.
+    * kind=Appointment, user: every appointment owned by user.
+    * kind=Photo or kind=File, user: every photo or file of user, with its
+      blob.
+    '''
+    def post(self):
+        kind = self.request.get('kind')
+        key = self.request.get('key')
+        email = self.request.get('user')
+        cursor = self.request.get('cursor')
+        if kind == 'Appointment' and key:
+            cursor = delete_records_batch(db.Key(key), self.request.get('storage'), cursor)
+        elif kind == 'Appointment' and email:
+            cursor = delete_appointments_batch(email, cursor)
+        elif kind in ('Photo', 'File') and email:
+            cursor = delete_blobs_batch({'Photo': Photo, 'File': File}[kind], email, cursor)
+        else:
+            return self.error(400)
+        if cursor:
+            params = {'kind': kind, 'cursor': cursor}
+            if key:
+                params['key'] = key
+                params['storage'] = self.request.get('storage')
+            if email:
+                params['user'] = email
+            task_queue.add('/tasks/delete', params)
 
 
 class ProfileHandler(BaseRequestHandler):
@@ -364,17 +2694,44 @@ class ProfileHandler(BaseRequestHandler):
         else:
             user = users.User(email)
 
-        invitations = Appointment.all().filter('invitee_list =', user.email())
-        appointments = Appointment.all().filter('email =', user.email())
+        is_owner = user == self.current_user
         photos = Photo.all().filter('user =', user)
-        if not user == self.current_user:
-            photos.filter('public =', True)
         files = File.all().filter('user =', user)
-        if not user == self.current_user:
+        if not is_owner:
+            photos.filter('public =', True)
             files.filter('public =', True)
-
-        upload_url = blobstore.create_upload_url('/upload')
-        self.generate('profile.html', {'photos': photos, 'files': files, 'appointments': appointments, 'invitations': invitations, 'upload_url': upload_url, 'user': user})
+        when = self.request.get('when') == 'past' and Appointment.past or Appointment.upcoming
+        queries = {
+            'invitations': when(Appointment.all().filter('invitee_list =', user.email())),
+            'appointments': when(Appointment.all().filter('email =', user.email())),
+            'photos': photos,
+            'files': files,
+            }
+
+        # Start every query and the upload URL RPC before waiting for any
+        if is_owner:
+            upload_rpc = blobstore.create_upload_url_async('/upload')
+        cursors = dict((name, self.request.get('%s_cursor' % name)) for name in queries)
+        try:
+            values, next_cursors = fetch_pages(queries, cursors, _PROFILE_LIMIT)
+        except (db.BadRequestError, db.BadValueError):
+            return self.error(400)
+
+        File.load_blob_infos(values['files'])
+        for name in ('invitations', 'appointments'):
+            values[name] = [a for a in values[name] if not a.deleted]
+        for name, cursor in next_cursors.items():
+            if cursor:
+                params = {'user': user.email(), '%s_cursor' % name: cursor}
+                if self.request.get('when'):
+                    params['when'] = self.request.get('when')
+                values['%s_next' % name] = '%s?%s' % (self.request.path, urllib.urlencode(params))
+        values['user'] = user
+        values['past'] = self.request.get('when') == 'past'
+        if is_owner:
+            values['upload_url'] = upload_rpc.get_result()
+            values['calendar_url'] = 'webcal://%s/calendar/%s.ics' % (self.request.host, CalendarFeed.token_for(user.email()))
+        self.generate('profile.html', values)
 
 
 class UploadHandler(blobstore_handlers.BlobstoreUploadHandler):
@@ -423,25 +2780,16 @@ class PhotosHandler(BaseRequestHandler):
         if not photo:
             return self.error(404)
 
-        blob_key = str(photo.blob_info.key())
-        img = images.Image(blob_key=blob_key)
-        img.im_feeling_lucky()
-        img.rotate(photo.rotate)
-        thumbnail = img.execute_transforms(output_encoding=images.JPEG)
-        if img.width > 500:
-            img.resize(width=500)
-            thumbnail = img.execute_transforms(output_encoding=images.JPEG)
-        self.response.headers['Content-Type'] = 'image/jpg'
-        self.response.out.write(thumbnail)
+        self.write_rendition(photo, _PHOTO_WIDTH)
 
 
-class FullPhotoHandler(blobstore_handlers.BlobstoreDownloadHandler):
+class FullPhotoHandler(BlobDownloadHandler):
     def get(self, photo_key):
         photo = Photo.get(photo_key)
         if not photo:
             return self.error(404)
 
-        self.send_blob(photo.blob_info)
+        self.send_owned_blob(photo)
 
 
 class ThumbHandler(BaseRequestHandler):
@@ -450,22 +2798,172 @@ class ThumbHandler(BaseRequestHandler):
         if not photo:
             return self.error(404)
 
-        blob_key = str(photo.blob_info.key())
-        img = images.Image(blob_key=blob_key)
-        img.resize(width=150)
-        img.im_feeling_lucky()
-        thumbnail = img.execute_transforms(output_encoding=images.JPEG)
-        self.response.headers['Content-Type'] = 'image/jpg'
-        self.response.out.write(thumbnail)
+        self.write_rendition(photo, _THUMB_WIDTH)
+
+
+class SpriteHandler(BaseRequestHandler):
+    def get(self):
+        '''
+        Returns, as JSON, the URL of the thumbnail sprite of the comma
+        separated photo keys and the offset of each photo in it.
+        '''
+        keys = [k for k in self.request.get('keys').split(',') if k]
+        if not keys or len(keys) > _SPRITE_PAGE:
+            return self.error(400)
+        try:
+            photos = [p for p in Photo.get(keys) if p]
+        except db.BadKeyError:
+            return self.error(400)
+        if not photos:
+            return self.error(404)
+
+        sprite = Sprite.get_or_build(photos)
+        self.write_json({
+            'url': '/photos/sprite/%s' % sprite.key().name(),
+            'cell': _SPRITE_CELL,
+            'offsets': simplejson.loads(sprite.offsets),
+            })
+
+
+class SpriteImageHandler(BaseRequestHandler):
+    def get(self, key_name):
+        '''
+        Serves a sprite image. Sprites never change, so they are cached for
+        long, by shared caches only when all their photos are public.
+        '''
+        sprite = memcache.get('sprite:%s' % key_name) or Sprite.get_by_key_name(key_name)
+        if not sprite:
+            return self.error(404)
+
+        if sprite.public:
+            self.response.headers['Cache-Control'] = 'public, max-age=%d' % _IMMUTABLE_MAX_AGE
+        else:
+            self.response.headers['Cache-Control'] = 'private, max-age=%d' % _IMMUTABLE_MAX_AGE
+        self.response.headers['Content-Type'] = 'image/jpeg'
+        self.response.out.write(sprite.data)
 
 
 class PhotoSearchHandler(BaseRequestHandler):
     def get(self):
+        '''
+        Searches the photos of user, or all public photos without user. Only
+        the owner finds private photos.
+        '''
         query = self.request.get('q')
         email = self.request.get('user')
-        user = users.User(urllib.unquote(email))
-        photos = (p for p in Photo.all().filter('user =', user) if query in p.comment)
-        self.generate('searchresult.html', {'photos': photos, 'query': query})
+        user = email and users.User(urllib.unquote(email)) or None
+        public_only = not user or user != self.current_user
+        try:
+            photos, cursor = search_comments(query, Photo, user, public_only, self.request.get('cursor'))
+        except (db.BadRequestError, db.BadValueError):
+            return self.error(400)
+        next_url = None
+        if cursor:
+            next_url = '/photo/search?%s' % urllib.urlencode({'q': query.encode('utf-8'), 'user': email, 'cursor': cursor})
+        self.generate('searchresult.html', {'photos': photos, 'query': query, 'next_url': next_url})
+
+
+class ReindexTaskHandler(webapp.RequestHandler):
+    ''' Task queue worker saving existing photos and files to index their keywords. '''
+    def post(self):
+        ''' Re-saves a batch of kind and queues a task for the next batch. '''
+        kind = self.request.get('kind')
+        model = {'Photo': Photo, 'File': File}.get(kind)
+        if not model:
+            return self.error(400)
+        q = model.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            q.with_cursor(cursor)
+        entities = q.fetch(_REINDEX_BATCH_SIZE)
+        put_batched(entities)
+        if len(entities) == _REINDEX_BATCH_SIZE:
+            task_queue.add('/tasks/reindex', {'kind': kind, 'cursor': q.cursor()})
+
+
+class MigrateInvitesTaskHandler(webapp.RequestHandler):
+    ''' Task queue worker moving old invites to deterministic keys. '''
+    def post(self):
+        '''
+        Copies a batch of invites saved with generated ids under their
+        appointment with deterministic key names, deletes the originals and
+        queues a task for the next batch.
+        '''
+        q = Invite.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            q.with_cursor(cursor)
+        invites = q.fetch(_MIGRATE_BATCH_SIZE)
+        legacy = [i for i in invites if i.key().parent() is None and Invite.appointment.get_value_for_datastore(i)]
+        copies = []
+        for invite in legacy:
+            appointment_key = Invite.appointment.get_value_for_datastore(invite)
+            copies.append(Invite(
+                parent=appointment_key,
+                key_name=Invite.key_name(invite.email, invite.date),
+                email=invite.email,
+                date=invite.date,
+                status=invite.status,
+                appointment=appointment_key,
+                ))
+        put_batched(copies)
+        db.delete(legacy)
+        if len(invites) == _MIGRATE_BATCH_SIZE:
+            task_queue.add('/tasks/migrate_invites', {'cursor': q.cursor()})
+
+
+class FreeBusyTaskHandler(webapp.RequestHandler):
+    ''' Task queue worker updating busy indexes, see FreeBusy.refresh. '''
+    def post(self):
+        try:
+            keys_by_email = simplejson.loads(self.request.get('keys'))
+        except ValueError:
+            return self.error(400)
+        keys = list(set([k for found in keys_by_email.values() for k in found]))
+        appointments = dict(zip(keys, keys and Appointment.get(keys) or []))
+        for email, found in keys_by_email.items():
+            FreeBusy.replace(email, found, appointments)
+
+
+class BackfillDatesTaskHandler(webapp.RequestHandler):
+    '''
+    Task queue worker re-saving appointments in batches, so that their
+    first, last and next dates are computed. Each task logs the cursor it
+    starts from: posting it again resumes an interrupted run.
+    '''
+    def get(self):
+        ''' Daily cron: moves forward the next date of the appointments it passed. '''
+        task_queue.add('/tasks/backfill_dates', {'stale': '1'})
+
+    def post(self):
+        '''
+        Re-saves a batch of size appointments (all of them, or with stale=1
+        the ones whose next date passed) and queues the next batch countdown
+        seconds later.
+        '''
+        try:
+            size = int(self.request.get('size', _BACKFILL_BATCH_SIZE))
+            countdown = int(self.request.get('countdown', _BACKFILL_COUNTDOWN))
+        except ValueError:
+            return self.error(400)
+        params = {'size': size, 'countdown': countdown}
+        q = Appointment.all()
+        if self.request.get('stale'):
+            # A range, as None sorts before every date. Saved appointments
+            # leave it, so every batch starts from the beginning.
+            q.filter('next_date >', datetime.datetime(1970, 1, 1))
+            q.filter('next_date <', datetime.datetime.utcnow())
+            params['stale'] = '1'
+            cursor = None
+        else:
+            cursor = self.request.get('cursor')
+            logging.info('Backfilling appointment dates from cursor %r', cursor)
+        appointments, next_cursor = fetch_page(q, cursor, size)
+        put_batched(appointments)
+        if next_cursor:
+            if not params.get('stale'):
+                params['cursor'] = next_cursor
+            task_queue.add('/tasks/backfill_dates', params, countdown=countdown)
 
 
 class PhotoRotateHandler(BaseRequestHandler):
@@ -482,6 +2980,7 @@ class PhotoRotateHandler(BaseRequestHandler):
         angle = int(self.request.get('angle', 0))
         photo.rotate += angle
         photo.put()
+        Rendition.purge(photo)
 
 
 class PhotoShareHandler(BaseRequestHandler):
@@ -498,6 +2997,7 @@ class PhotoShareHandler(BaseRequestHandler):
         public = bool(self.request.get('public'))
         photo.public = public
         photo.put()
+        Sprite.purge(photo)
 
 
 class PhotoRemoveHandler(BaseRequestHandler):
@@ -511,17 +3011,18 @@ class PhotoRemoveHandler(BaseRequestHandler):
         if photo.user != self.current_user:
             return self.error(405)
 
+        Rendition.purge(photo)
         photo.blob_info.delete()
         photo.delete()
 
 
-class FilesHandler(blobstore_handlers.BlobstoreDownloadHandler):
+class FilesHandler(BlobDownloadHandler):
     def get(self, file_key, file_name):
         file_ = File.get(file_key)
         if not file_:
             return self.error(404)
 
-        self.send_blob(file_.blob_info)
+        self.send_owned_blob(file_)
 
 
 class FileRemoveHandler(BaseRequestHandler):
@@ -557,7 +3058,42 @@ class FileShareHandler(BaseRequestHandler):
 class PublicFilesHandler(BaseRequestHandler):
     def get(self):
         files = File.all().filter('public =', True)
-        self.generate('publicfiles.html', {'files': files})
+        self.generate_page('publicfiles.html', 'files', files)
+
+
+class StatsHandler(BaseRequestHandler):
+    @admin_required
+    def get(self):
+        '''
+        Returns the rolling request and RPC histograms of this instance and
+        the requests flagged as N+1 patterns.
+        '''
+        self.write_json(instrumentation.registry.snapshot())
+
+
+class CacheStatsHandler(BaseRequestHandler):
+    @admin_required
+    def get(self):
+        ''' Returns the entity cache counters of this instance and memcache's. '''
+        stats = dict(CachedModel.stats)
+        stats['local_size'] = len(CachedModel._local)
+        stats['memcache'] = memcache.get_stats()
+        self.write_json(stats)
+
+
+class WarmupHandler(webapp.RequestHandler):
+    def get(self):
+        '''
+        Warmup request of a new instance, before it gets traffic: compiles
+        every template and loads the translation catalog and the asset
+        manifest.
+        '''
+        directory = os.path.join(os.path.dirname(__file__), 'template')
+        for name in os.listdir(directory):
+            if name.endswith('.html'):
+                get_template(name)
+        translation.activate(django_settings.LANGUAGE_CODE)
+        assets.load_manifest()
 
 
 class Http404(BaseRequestHandler):
@@ -565,15 +3101,36 @@ class Http404(BaseRequestHandler):
         return self.error(404)
 
 
-if __name__ == '__main__':
-    application = webapp.WSGIApplication([
+def flush_tasks(application):
+    ''' WSGI middleware adding the tasks queued while handling a request. '''
+    def wrapper(environ, start_response):
+        try:
+            return application(environ, start_response)
+        finally:
+            task_queue.flush()
+    return wrapper
+
+
+def make_application():
+    ''' The instrumented WSGI application serving every route. '''
+    routes = [
         (r'/', HomeHandler),
         (r'/new', NewAppointmentHandler),
         (r'/appointment', AppointmentHandler),
         (r'/appointment/remove', AppointmentRemoveHandler),
+        (r'/appointment/ranking', RankingHandler),
+        (r'/appointment/dates', AppointmentDatesHandler),
         (r'/appointments', AppointmentsHandler),
+        (r'/appointments/bulk', BulkAppointmentHandler),
+        (r'/calendar/([^/]+)\.ics', CalendarHandler),
+        (r'/freebusy', FreeBusyHandler),
+        (r'/export', ExportHandler),
+        (r'/import', ImportHandler),
         (r'/availability', AvailabilityHandler),
+        (r'/availability/matrix', AvailabilityMatrixHandler),
+        (r'/availability/bulk', BulkAvailabilityHandler),
         (r'/profile', ProfileHandler),
+        (r'/profile/remove', AccountCleanupHandler),
         (r'/profile/([^/]+)', ProfileHandler),
         (r'/upload', UploadHandler),
         (r'/toolarge', TooLargeHandler),
@@ -582,7 +3139,9 @@ if __name__ == '__main__':
         (r'/photo/([^/]+)', PhotoHandler),
         (r'/photo/([^/]+)/full', FullPhotoHandler),
         (r'/photos/remove', PhotoRemoveHandler),
-        (r'/photos/thumb', ThumbHandler),
+        (r'/photos/thumb/([^/]+)', ThumbHandler),
+        (r'/photos/sprite', SpriteHandler),
+        (r'/photos/sprite/([^/]+)', SpriteImageHandler),
         (r'/photos/rotate', PhotoRotateHandler),
         (r'/photos/share', PhotoShareHandler),
         (r'/photos/([^/]+)', PhotosHandler),
@@ -590,7 +3149,30 @@ if __name__ == '__main__':
         (r'/files/share', FileShareHandler),
         (r'/files/public', PublicFilesHandler),
         (r'/files/([^/]+)/([^/]+)', FilesHandler),
+        (r'/tasks/mail', MailTaskHandler),
+        (r'/tasks/reindex', ReindexTaskHandler),
+        (r'/tasks/delete', CascadeDeleteTaskHandler),
+        (r'/tasks/migrate_invites', MigrateInvitesTaskHandler),
+        (r'/tasks/backfill_dates', BackfillDatesTaskHandler),
+        (r'/tasks/freebusy', FreeBusyTaskHandler),
+        (r'/stats', StatsHandler),
+        (r'/stats/cache', CacheStatsHandler),
+        (r'/_ah/warmup', WarmupHandler),
         (r'/.*', Http404),
-        ], debug=_DEBUG)
+        ]
+    instrumentation.install_hooks()
+    return instrumentation.StatsMiddleware(flush_tasks(webapp.WSGIApplication(routes, debug=_DEBUG)), routes)
+
+
+# Built once per process: the runtime caches this module and only calls main()
+# for the following requests
+application = make_application()
+
+
+def main():
     run_wsgi_app(application)
 
+
+if __name__ == '__main__':
+    main()
+
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+'''
+Fingerprinted static assets.
+
+Run before deploying:
+
+    python assets.py
+
+It copies every file under static/ to static/build/ with a hash of its
+content in the name, bundles and minifies the files of each BUNDLES entry
+into one file, and writes the manifest, assets.json, mapping names to the
+URLs built. Those URLs change whenever the content does, so app.yaml serves
+static/build/ with a year long expiration. Without a manifest, on a
+development checkout, names resolve to the files under static/.
+'''
+
+import os
+import sys
+import hashlib
+import posixpath
+import re
+import shutil
+try:
+    import json
+except ImportError:
+    from django.utils import simplejson as json
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC = os.path.join(ROOT, 'static')
+BUILD = os.path.join(STATIC, 'build')
+MANIFEST = os.path.join(ROOT, 'assets.json')
+
+# Files under static/ served as one file each, by bundle name
+BUNDLES = {
+    'base.css': ['css/style.css', 'css/ui-lightness/jquery-ui-1.8.1.custom.css'],
+    'base.js': ['js/jquery-1.4.2.min.js', 'js/jquery-ui-1.8.1.custom.min.js'],
+    'gallery.js': ['js/galleria.js', 'js/photosprite.js'],
+    'new.js': ['js/jquery-dynamic-form.js', 'js/jquery.timeentry.js'],
+    }
+
+# Directories whose files load each other by relative URL, such as Galleria
+# themes: they are copied whole under a name hashing all their files
+DIRECTORIES = ['css/galleria-classic']
+
+_CSS_URL = re.compile(r'''url\(\s*['"]?([^'")]+?)['"]?\s*\)''')
+
+_manifest = []
+
+
+def load_manifest():
+    ''' The manifest of the last build, or {} when there is none. '''
+    if not _manifest:
+        try:
+            f = open(MANIFEST)
+            try:
+                _manifest.append(json.load(f))
+            finally:
+                f.close()
+        except IOError:
+            _manifest.append({})
+    return _manifest[0]
+
+
+def url(name):
+    ''' URL of the asset name, a path under static/. '''
+    return load_manifest().get(name) or '/static/%s' % name
+
+
+def tag(src):
+    if src.endswith('.css'):
+        return '<link rel="stylesheet" type="text/css" href="%s" />' % src
+    return '<script src="%s"></script>' % src
+
+
+def tags(name):
+    '''
+    HTML tags loading the bundle or file name: the built file, or without a
+    build each file of the bundle.
+    '''
+    manifest = load_manifest()
+    if name in manifest:
+        return tag(manifest[name])
+    return '\n'.join([tag('/static/%s' % f) for f in BUNDLES.get(name, [name])])
+
+
+def minify_css(text):
+    '''
+    Drops comments and the spaces around braces, semicolons and commas.
+
+    >>> minify_css('a, b {\\n  color: red; /* red */\\n}\\n')
+    'a,b{color: red;}'
+    '''
+    text = re.sub(r'(?s)/\*.*?\*/', '', text)
+    text = re.sub(r'\s+', ' ', text)
+    return re.sub(r'\s*([{};,])\s*', r'\1', text).strip()
+
+
+def minify_js(text):
+    '''
+    Minifies with jsmin when it is installed. Otherwise only drops
+    indentation, blank lines and whole line comments, which is always safe.
+    '''
+    try:
+        from jsmin import jsmin
+    except ImportError:
+        lines = [line.strip() for line in text.splitlines()]
+        return '\n'.join([line for line in lines if line and not line.startswith('//')])
+    return jsmin(text)
+
+
+def fingerprint(path, data):
+    ''' path, relative to static/, with a hash of data before the extension. '''
+    root, ext = posixpath.splitext(path)
+    return '%s.%s%s' % (root, hashlib.md5(data).hexdigest()[:12], ext)
+
+
+def read(path):
+    f = open(os.path.join(STATIC, *path.split('/')), 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def write(path, data):
+    target = os.path.join(BUILD, *path.split('/'))
+    if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    f = open(target, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return '/static/build/%s' % path
+
+
+def rewrite_css_urls(path, text, manifest):
+    ''' Points the url()s of the stylesheet path at the built files. '''
+    def replace(match):
+        ref = match.group(1)
+        if ref.startswith('data:') or '//' in ref:
+            return match.group(0)
+        if ref.startswith('/static/'):
+            name = ref[len('/static/'):]
+        else:
+            name = posixpath.normpath(posixpath.join(posixpath.dirname(path), ref))
+        return 'url(%s)' % manifest.get(name, ref)
+    return _CSS_URL.sub(replace, text)
+
+
+def static_files():
+    ''' Paths, relative to static/, of the source files. '''
+    paths = []
+    for directory, dirnames, filenames in os.walk(STATIC):
+        if directory == STATIC and 'build' in dirnames:
+            dirnames.remove('build')
+        relative = directory[len(STATIC):].strip(os.sep).replace(os.sep, '/') or '.'
+        for filename in filenames:
+            paths.append(posixpath.normpath(posixpath.join(relative, filename)))
+    return sorted(paths)
+
+
+def build(out=sys.stdout):
+    if os.path.isdir(BUILD):
+        shutil.rmtree(BUILD)
+    manifest = {}
+    paths = static_files()
+
+    # Stylesheets last, once the files they refer to are built
+    for path in [p for p in paths if not p.endswith('.css')] + [p for p in paths if p.endswith('.css')]:
+        if [d for d in DIRECTORIES if path.startswith(d + '/')]:
+            continue
+        data = read(path)
+        if path.endswith('.css'):
+            data = rewrite_css_urls(path, data.decode('utf-8'), manifest).encode('utf-8')
+        manifest[path] = write(fingerprint(path, data), data)
+
+    for directory in DIRECTORIES:
+        files = [p for p in paths if p.startswith(directory + '/')]
+        digest = hashlib.md5()
+        for path in files:
+            digest.update(path.encode('utf-8'))
+            digest.update(read(path))
+        target = '%s-%s' % (directory, digest.hexdigest()[:12])
+        for path in files:
+            manifest[path] = write(target + path[len(directory):], read(path))
+
+    for name in sorted(BUNDLES):
+        parts = []
+        for path in BUNDLES[name]:
+            text = read(path).decode('utf-8')
+            if name.endswith('.css'):
+                parts.append(minify_css(rewrite_css_urls(path, text, manifest)))
+            elif path.endswith('.min.js'):
+                parts.append(text)
+            else:
+                parts.append(minify_js(text))
+        separator = name.endswith('.js') and ';\n' or '\n'
+        data = separator.join(parts).encode('utf-8')
+        manifest[name] = write(fingerprint(name, data), data)
+        out.write('%s: %s, %d bytes\n' % (name, manifest[name], len(data)))
+
+    f = open(MANIFEST, 'w')
+    try:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    finally:
+        f.close()
+    out.write('%d assets, manifest written to %s\n' % (len(manifest), MANIFEST))
+
+
+if __name__ == '__main__':
+    build()
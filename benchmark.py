@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+'''
+Local benchmark of the application handlers.
+
+Boots the application from appointment.py against the App Engine SDK stand-ins
+for the datastore, memcache, mail, images and blobstore, loads a synthetic
+workload (appointments with N invitees x M dates, a photo library, concurrent
+availability updates) and reports, per route, the latency percentiles and the
+RPCs per request recorded by instrumentation. Needs only the SDK, no network:
+
+    python benchmark.py --sdk ~/google_appengine --save-baseline
+    ... change the code ...
+    python benchmark.py --sdk ~/google_appengine
+
+The second run compares its results with the stored baseline and exits with
+status 1 on a regression. Runs with the same options and seed send the same
+requests, so RPC counts are comparable exactly and latencies within noise.
+'''
+
+import os
+import sys
+import datetime
+import hashlib
+import logging
+import optparse
+import random
+import threading
+import time
+from StringIO import StringIO
+
+
+# Default location of the stored baseline
+_BASELINE = 'benchmark_baseline.json'
+
+# Owner of the generated appointments and photos; logged in for every request
+_OWNER = 'owner@example.com'
+
+# Options defining the workload; results are only comparable when they match
+_WORKLOAD = ('appointments', 'invitees', 'dates', 'storage', 'photos', 'requests', 'updates', 'threads', 'seed')
+
+# Words the photo comments and the search queries are made of
+_WORDS = ('beach', 'birthday', 'mountain', 'party', 'sunset', 'wedding',
+          'garden', 'concert', 'holiday', 'family', 'office', 'river')
+
+
+def setup_sdk(sdk_path):
+    ''' Puts the SDK and its bundled libraries (webapp, Django 0.96) on sys.path. '''
+    sdk_path = os.path.abspath(os.path.expanduser(sdk_path))
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_stubs():
+    '''
+    Activates a testbed with local stand-ins for every service the handlers
+    use. Returns the testbed and whether the images service is available: its
+    stub needs PIL, without which the thumbnail workload is skipped.
+    '''
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    # Not a development server: templates are compiled once, as in production
+    bed.setup_env(
+        app_id='appointment421',
+        SERVER_SOFTWARE='Benchmark/1.0',
+        USER_EMAIL=_OWNER,
+        USER_ID='1',
+        USER_IS_ADMIN='1',
+        AUTH_DOMAIN='gmail.com',
+        overwrite=True)
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_mail_stub()
+    bed.init_blobstore_stub()
+    bed.init_user_stub()
+    bed.init_taskqueue_stub()
+    try:
+        bed.init_images_stub()
+        has_images = True
+    except testbed.StubNotSupportedError:
+        has_images = False
+    return bed, has_images
+
+
+def make_image(rng, width=640, height=480):
+    ''' A JPEG of a random flat colour, or None without PIL. '''
+    try:
+        from PIL import Image
+    except ImportError:
+        try:
+            import Image
+        except ImportError:
+            return None
+    colour = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+    out = StringIO()
+    Image.new('RGB', (width, height), colour).save(out, 'JPEG')
+    return out.getvalue()
+
+
+def create_blob(bed, data, content_type, filename):
+    ''' Stores data in the local blobstore and returns its BlobKey. '''
+    from google.appengine.api import datastore
+    from google.appengine.ext import blobstore
+    blob_key = hashlib.md5('%s:%s' % (filename, len(data))).hexdigest()
+    bed.get_stub('blobstore').storage.StoreBlob(blob_key, StringIO(data))
+    info = datastore.Entity(blobstore.BLOB_INFO_KIND, name=blob_key, namespace='')
+    info['content_type'] = content_type
+    info['creation'] = datetime.datetime(2012, 1, 1)
+    info['filename'] = filename
+    info['size'] = len(data)
+    info['md5_hash'] = hashlib.md5(data).hexdigest()
+    datastore.Put(info)
+    return blobstore.BlobKey(blob_key)
+
+
+class Benchmark(object):
+    ''' Synthetic workload driving the application in process. '''
+    def __init__(self, options, bed, has_images):
+        import appointment
+        import instrumentation
+        self.appointment = appointment
+        self.instrumentation = instrumentation
+        self.options = options
+        self.bed = bed
+        self.has_images = has_images
+        self.rng = random.Random(options.seed)
+        self.queue = appointment.LocalQueue()
+        appointment.task_queue = self.queue
+        self.application = appointment.application
+        self.errors = {}
+        self._lock = threading.Lock()
+        self.invitees = ['guest%d@example.com' % i for i in range(options.invitees)]
+        start = datetime.datetime(2013, 1, 7, 9, 0)
+        self.dates = [start + datetime.timedelta(days=i, hours=i % 8) for i in range(options.dates)]
+        self.appointments = []
+        self.photos = []
+
+    def call(self, method, url, params=None):
+        status, headers, body = self.appointment.call_application(self.application, method, url, params)
+        if status >= 400:
+            self._lock.acquire()
+            try:
+                name = '%s %s' % (method, url.split('?')[0])
+                self.errors[name] = self.errors.get(name, 0) + 1
+            finally:
+                self._lock.release()
+        return status, dict(headers), body
+
+    def format(self, date):
+        return date.strftime(self.appointment.settings.DATETIME_FORMAT)
+
+    def create_appointments(self):
+        ''' POST /new, running the invitation mails it queues. '''
+        for i in range(self.options.appointments):
+            status, headers, body = self.call('POST', '/new', {
+                'description': 'Benchmark appointment %d' % i,
+                'invitees': ', '.join(self.invitees),
+                'date[]': [d.strftime('%Y-%m-%d') for d in self.dates],
+                'time[]': [d.strftime('%H:%M') for d in self.dates],
+                'storage': self.options.storage,
+                })
+            location = headers.get('Location', '')
+            if 'key=' in location:
+                self.appointments.append(location.split('key=')[1].split('&')[0])
+            self.queue.run(self.application)
+
+    def create_photos(self):
+        ''' Stores a photo library of the owner directly, uploads are not benchmarked. '''
+        from google.appengine.api import users
+        if not self.options.photos:
+            return
+        data = make_image(self.rng)
+        content_type = 'image/jpeg'
+        if data is None:
+            data, content_type = 'not an image', 'application/octet-stream'
+        owner = users.User(_OWNER)
+        photos = []
+        for i in range(self.options.photos):
+            comment = ' '.join(self.rng.sample(_WORDS, 3))
+            photos.append(self.appointment.Photo(
+                user=owner,
+                blob_info=create_blob(self.bed, data, content_type, 'photo%d.jpg' % i),
+                comment=comment,
+                public=bool(i % 2)))
+        self.photos = [str(k) for k in self.appointment.put_batched(photos)]
+
+    def read_routes(self):
+        ''' GETs of the pages and images, spread over the generated data. '''
+        rng = self.rng
+        for i in range(self.options.requests):
+            if self.appointments:
+                key = rng.choice(self.appointments)
+                invitee = rng.choice(self.invitees)
+                self.call('GET', '/appointment', {'key': key, 'user': invitee})
+                self.call('GET', '/availability', {
+                    'key': key,
+                    'email': invitee,
+                    'user': invitee,
+                    'date': self.format(rng.choice(self.dates)),
+                    })
+            self.call('GET', '/profile')
+            self.call('GET', '/profile', {'user': rng.choice(self.invitees or [_OWNER])})
+            self.call('GET', '/photo/search', {'q': rng.choice(_WORDS), 'user': _OWNER})
+            if self.photos and self.has_images:
+                self.call('GET', '/photos/thumb/%s' % rng.choice(self.photos))
+
+    def update_availability(self):
+        ''' POST /availability from options.threads concurrent clients. '''
+        if not self.appointments:
+            return
+        statuses = list(self.appointment._STATUSES)
+        def client(seed, count):
+            rng = random.Random(seed)
+            for i in range(count):
+                self.call('POST', '/availability', {
+                    'key': rng.choice(self.appointments),
+                    'user': rng.choice(self.invitees),
+                    'date': self.format(rng.choice(self.dates)),
+                    'availability': rng.choice(statuses),
+                    })
+        threads = []
+        per_thread = self.options.updates // self.options.threads
+        for t in range(self.options.threads):
+            threads.append(threading.Thread(target=client, args=(self.options.seed + t, per_thread)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def remove_appointments(self):
+        ''' POST /appointment/remove, running the cascading deletes it queues. '''
+        for key in self.appointments:
+            self.call('POST', '/appointment/remove', {'key': key})
+        self.queue.run(self.application)
+
+    def run(self):
+        self.create_photos()
+        self.instrumentation.registry = self.instrumentation.Registry()
+        started = time.time()
+        self.create_appointments()
+        self.read_routes()
+        self.update_availability()
+        self.remove_appointments()
+        elapsed = time.time() - started
+        return summarize(self.instrumentation.registry.snapshot(), elapsed, self.errors)
+
+
+def summarize(snapshot, elapsed, errors):
+    ''' Keeps, per route, the latency percentiles and the mean RPCs per request. '''
+    routes = {}
+    for name, route in snapshot['routes'].items():
+        wall = route['wall_ms']
+        rpcs = dict((service, h['mean']) for service, h in route['rpcs'].items() if h['count'])
+        routes[name] = {
+            'requests': wall['count'],
+            'p50': wall['p50'],
+            'p90': wall['p90'],
+            'p99': wall['p99'],
+            'rpcs': sum(rpcs.values()),
+            'rpcs_by_service': rpcs,
+            }
+    return {
+        'elapsed': elapsed,
+        'routes': routes,
+        'errors': errors,
+        'n_plus_one': snapshot['n_plus_one'],
+        }
+
+
+def compare(result, baseline, tolerance):
+    '''
+    Lists the regressions of result against baseline: a p50 latency more than
+    tolerance slower, or more RPCs per request.
+
+    >>> old = {'routes': {'/': {'p50': 10.0, 'rpcs': 2.0}}}
+    >>> compare({'routes': {'/': {'p50': 11.0, 'rpcs': 2.0}}}, old, 0.25)
+    []
+    >>> compare({'routes': {'/': {'p50': 20.0, 'rpcs': 3.0}}}, old, 0.25)
+    ['/: p50 20.0 ms > 10.0 ms', '/: 3.0 RPCs per request > 2.0']
+    '''
+    regressions = []
+    for name in sorted(result['routes']):
+        new, old = result['routes'][name], baseline['routes'].get(name)
+        if not old:
+            continue
+        if new['p50'] > old['p50'] * (1 + tolerance):
+            regressions.append('%s: p50 %.1f ms > %.1f ms' % (name, new['p50'], old['p50']))
+        if new['rpcs'] > old['rpcs'] + 0.05:
+            regressions.append('%s: %.1f RPCs per request > %.1f' % (name, new['rpcs'], old['rpcs']))
+    return regressions
+
+
+def report(result, baseline, out=sys.stdout):
+    out.write('%-28s %8s %9s %9s %9s %7s %9s\n' % (
+        'route', 'requests', 'p50 ms', 'p90 ms', 'p99 ms', 'RPCs', 'p50 diff'))
+    for name in sorted(result['routes']):
+        route = result['routes'][name]
+        diff = ''
+        old = baseline and baseline['routes'].get(name)
+        if old and old['p50']:
+            diff = '%+.0f%%' % ((route['p50'] - old['p50']) * 100 / old['p50'])
+        out.write('%-28s %8d %9.1f %9.1f %9.1f %7.1f %9s\n' % (
+            name, route['requests'], route['p50'], route['p90'], route['p99'], route['rpcs'], diff))
+    out.write('\ntotal %.1f s\n' % result['elapsed'])
+    for name, count in sorted(result['errors'].items()):
+        out.write('errors: %s answered %d times with 4xx/5xx\n' % (name, count))
+    for name, count in sorted(result['n_plus_one'].items()):
+        out.write('N+1: %s, up to %d calls\n' % (name, count))
+
+
+def add_baseline_options(parser, baseline, slowdown='slowdown'):
+    ''' Adds the options storing and comparing a baseline to parser. '''
+    parser.add_option('--baseline', default=baseline, help='baseline file [%default]')
+    parser.add_option('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_option('--tolerance', type='float', default=0.25,
+                      help='%s tolerated before a regression is reported [%%default]' % slowdown)
+
+
+def check_baseline(result, options, setting, report, compare, out=sys.stdout):
+    '''
+    Reports result with report(result, baseline, out). With --save-baseline
+    stores result as the baseline, otherwise lists the regressions found by
+    compare(result, baseline, tolerance). A baseline with another
+    result[setting] is reported with a warning. Returns the exit status, 1
+    on a regression.
+    '''
+    from django.utils import simplejson
+    baseline = None
+    if not options.save_baseline and os.path.exists(options.baseline):
+        baseline = simplejson.load(open(options.baseline))
+        if baseline.get(setting) != result[setting]:
+            out.write('warning: the baseline was run with another %s\n' % setting)
+    report(result, baseline, out)
+
+    if options.save_baseline:
+        f = open(options.baseline, 'w')
+        try:
+            simplejson.dump(result, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        out.write('baseline saved to %s\n' % options.baseline)
+    elif baseline:
+        regressions = compare(result, baseline, options.tolerance)
+        for regression in regressions:
+            out.write('regression: %s\n' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]', description=__doc__.strip().split('\n\n')[0])
+    parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK', '/usr/local/google_appengine'),
+                      help='App Engine SDK directory [%default]')
+    parser.add_option('--appointments', type='int', default=10, help='appointments created [%default]')
+    parser.add_option('--invitees', type='int', default=50, help='invitees of each appointment [%default]')
+    parser.add_option('--dates', type='int', default=10, help='dates of each appointment [%default]')
+    parser.add_option('--storage', default='invites', help='storage mode of the appointments [%default]')
+    parser.add_option('--photos', type='int', default=200, help='photos in the library [%default]')
+    parser.add_option('--requests', type='int', default=50, help='requests to each read route [%default]')
+    parser.add_option('--updates', type='int', default=400, help='availability updates [%default]')
+    parser.add_option('--threads', type='int', default=4, help='concurrent availability clients [%default]')
+    parser.add_option('--seed', type='int', default=421, help='random seed [%default]')
+    add_baseline_options(parser, _BASELINE, 'p50 slowdown')
+    options, args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    setup_sdk(options.sdk)
+    bed, has_images = setup_stubs()
+    if not has_images:
+        sys.stdout.write('PIL is not installed: no images stub, /photos/thumb is skipped\n')
+
+    try:
+        result = Benchmark(options, bed, has_images).run()
+    finally:
+        bed.deactivate()
+    result['workload'] = dict((name, getattr(options, name)) for name in _WORKLOAD)
+    return check_baseline(result, options, 'workload', report, compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+''' Request timing and RPC instrumentation. '''
+
+import logging
+import re
+import threading
+import time
+
+# GAE imports
+from google.appengine.api import apiproxy_stub_map
+from django.utils import simplejson
+
+
+# Samples kept by each rolling histogram
+_WINDOW = 1000
+
+# Upper bounds of the histogram buckets, in milliseconds or bytes
+_TIME_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+_SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576)
+
+# Calls of the same RPC in one request above which the request is flagged
+# as an N+1 pattern
+N_PLUS_ONE_THRESHOLD = 20
+
+
+class RollingHistogram(object):
+    '''
+    Distribution of the last window samples.
+
+    >>> h = RollingHistogram(window=3, buckets=(10, 100))
+    >>> for value in (1, 20, 30, 500):
+    ...     h.add(value)
+    >>> s = h.snapshot()
+    >>> s['count'], s['max'], sorted(s['buckets'].items())
+    (3, 500, [('10', 0), ('100', 2), ('inf', 1)])
+    '''
+    def __init__(self, window=_WINDOW, buckets=_TIME_BUCKETS):
+        self.window = window
+        self.buckets = buckets
+        self.samples = []
+        self._next = 0
+
+    def add(self, value):
+        if len(self.samples) < self.window:
+            self.samples.append(value)
+        else:
+            self.samples[self._next] = value
+            self._next = (self._next + 1) % self.window
+
+    def snapshot(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {'count': 0}
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(len(samples) * p))]
+        buckets = dict((str(b), 0) for b in self.buckets)
+        buckets['inf'] = 0
+        for value in samples:
+            for bound in self.buckets:
+                if value <= bound:
+                    buckets[str(bound)] += 1
+                    break
+            else:
+                buckets['inf'] += 1
+        return {
+            'count': len(samples),
+            'mean': sum(samples) / float(len(samples)),
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': samples[-1],
+            'buckets': buckets,
+            }
+
+
+class RequestStats(object):
+    ''' RPCs made while handling one request. '''
+    def __init__(self):
+        self.calls = {}
+        self._started = {}
+
+    def start(self, request):
+        self._started[id(request)] = time.time()
+
+    def finish(self, service, call, request):
+        started = self._started.pop(id(request), None)
+        elapsed = started and (time.time() - started) * 1000 or 0.0
+        count, total = self.calls.get((service, call), (0, 0.0))
+        self.calls[(service, call)] = (count + 1, total + elapsed)
+        return elapsed
+
+    def service_counts(self):
+        counts = {}
+        for (service, call), (count, total) in self.calls.items():
+            counts[service] = counts.get(service, 0) + count
+        return counts
+
+
+class Registry(object):
+    ''' Rolling per-route and per-RPC histograms of this instance. '''
+    def __init__(self):
+        self.routes = {}
+        self.rpcs = {}
+        self.n_plus_one = {}
+
+    def route(self, name):
+        if name not in self.routes:
+            self.routes[name] = {
+                'wall_ms': RollingHistogram(),
+                'response_bytes': RollingHistogram(buckets=_SIZE_BUCKETS),
+                'rpcs': {},
+                }
+        return self.routes[name]
+
+    def record_rpc(self, service, call, elapsed):
+        name = '%s.%s' % (service, call)
+        if name not in self.rpcs:
+            self.rpcs[name] = RollingHistogram()
+        self.rpcs[name].add(elapsed)
+
+    def record_request(self, name, method, status, wall, size, stats):
+        route = self.route(name)
+        route['wall_ms'].add(wall)
+        route['response_bytes'].add(size)
+        counts = stats.service_counts()
+        for service in set(counts.keys()) | set(route['rpcs'].keys()):
+            if service not in route['rpcs']:
+                route['rpcs'][service] = RollingHistogram(buckets=(0, 1, 2, 5, 10, 20, 50, 100))
+            route['rpcs'][service].add(counts.get(service, 0))
+
+        flagged = []
+        for (service, call), (count, total) in stats.calls.items():
+            if count > N_PLUS_ONE_THRESHOLD:
+                rpc = '%s.%s' % (service, call)
+                flagged.append(rpc)
+                key = '%s %s' % (name, rpc)
+                self.n_plus_one[key] = max(self.n_plus_one.get(key, 0), count)
+                logging.warning('N+1: %s %s made %d %s calls', method, name, count, rpc)
+
+        logging.info('request %s', simplejson.dumps({
+            'route': name,
+            'method': method,
+            'status': status,
+            'wall_ms': round(wall, 1),
+            'response_bytes': size,
+            'rpcs': dict(('%s.%s' % k, {'count': v[0], 'ms': round(v[1], 1)}) for k, v in stats.calls.items()),
+            'n_plus_one': flagged,
+            }))
+
+    def snapshot(self):
+        routes = {}
+        for name, route in self.routes.items():
+            routes[name] = {
+                'wall_ms': route['wall_ms'].snapshot(),
+                'response_bytes': route['response_bytes'].snapshot(),
+                'rpcs': dict((s, h.snapshot()) for s, h in route['rpcs'].items()),
+                }
+        return {
+            'routes': routes,
+            'rpc_ms': dict((name, h.snapshot()) for name, h in self.rpcs.items()),
+            'n_plus_one': self.n_plus_one,
+            }
+
+
+registry = Registry()
+_local = threading.local()
+
+
+def current():
+    ''' RequestStats of the request being handled by this thread, or None. '''
+    return getattr(_local, 'stats', None)
+
+
+def _pre_call_hook(service, call, request, response, *args, **kwargs):
+    stats = current()
+    if stats:
+        stats.start(request)
+
+
+def _post_call_hook(service, call, request, response, *args, **kwargs):
+    stats = current()
+    if stats:
+        registry.record_rpc(service, call, stats.finish(service, call, request))
+
+
+_hooks_installed = []
+
+def install_hooks():
+    ''' Registers the API proxy hooks timing every RPC, once per process. '''
+    if not _hooks_installed:
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('instrumentation', _pre_call_hook)
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('instrumentation', _post_call_hook)
+        _hooks_installed.append(True)
+
+
+class StatsMiddleware(object):
+    '''
+    WSGI middleware recording the wall time, response size and RPCs of each
+    request under the pattern of the route that matched it.
+    '''
+    def __init__(self, application, routes):
+        self.application = application
+        self.routes = [(re.compile('^%s$' % pattern), pattern) for pattern, handler in routes]
+
+    def route(self, path):
+        for regexp, pattern in self.routes:
+            if regexp.match(path):
+                return pattern
+        return path
+
+    def __call__(self, environ, start_response):
+        stats = RequestStats()
+        _local.stats = stats
+        status = []
+        def _start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split()[0]))
+            return start_response(status_line, headers, exc_info)
+
+        start = time.time()
+        body = []
+        try:
+            body = list(self.application(environ, _start_response))
+        finally:
+            _local.stats = None
+            wall = (time.time() - start) * 1000
+            size = sum([len(chunk) for chunk in body])
+            registry.record_request(
+                self.route(environ.get('PATH_INFO', '')),
+                environ.get('REQUEST_METHOD'),
+                status and status[0] or 500,
+                wall, size, stats)
+        return body
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+'''
+Cold start measurement of the application.
+
+Starts fresh Python processes against the App Engine SDK stand-ins, as a new
+instance would be, and times in each one the import of appointment.py, module
+by module, and the first request, with and without a warmup request before
+it. Reports the medians over the runs and the slowest imports:
+
+    python startup.py --sdk ~/google_appengine --save-baseline
+    ... change the code ...
+    python startup.py --sdk ~/google_appengine
+
+The second run compares its results with the stored baseline and exits with
+status 1 on a regression.
+'''
+
+import os
+import sys
+import optparse
+import subprocess
+import time
+
+import benchmark
+
+
+# Default location of the stored baseline
+_BASELINE = 'startup_baseline.json'
+
+# Slowest imports listed by the report
+_SLOWEST = 15
+
+
+class ImportTimer(object):
+    '''
+    Wraps the import statement to time the first import of each module:
+    inclusive time, with the modules it imports in turn, and self time.
+    '''
+    def __init__(self):
+        self.inclusive = {}
+        self.own = {}
+        self._stack = []
+        self._import = None
+
+    def install(self):
+        import __builtin__
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self.timed_import
+
+    def uninstall(self):
+        import __builtin__
+        __builtin__.__import__ = self._import
+
+    def timed_import(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self._import(name, *args, **kwargs)
+        self._stack.append(0.0)
+        start = time.time()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            elapsed = (time.time() - start) * 1000
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            if name not in self.inclusive:
+                self.inclusive[name] = elapsed
+                self.own[name] = elapsed - children
+
+
+def child(options):
+    ''' One cold start, in this process; writes its timings as JSON. '''
+    benchmark.setup_sdk(options.sdk)
+    bed, has_images = benchmark.setup_stubs()
+    from django.utils import simplejson
+
+    timer = ImportTimer()
+    timer.install()
+    start = time.time()
+    try:
+        import appointment
+    finally:
+        timer.uninstall()
+    result = {'import_ms': (time.time() - start) * 1000, 'modules': timer.own}
+
+    if options.child == 'warm':
+        start = time.time()
+        appointment.call_application(appointment.application, 'GET', '/_ah/warmup')
+        result['warmup_ms'] = (time.time() - start) * 1000
+
+    start = time.time()
+    status, headers, body = appointment.call_application(appointment.application, 'GET', options.url)
+    result['first_request_ms'] = (time.time() - start) * 1000
+    result['status'] = status
+    bed.deactivate()
+    sys.stdout.write(simplejson.dumps(result))
+
+
+def run_child(options, mode):
+    command = [sys.executable, os.path.abspath(__file__), '--child', mode,
+               '--sdk', options.sdk, '--url', options.url]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    out = process.communicate()[0]
+    if process.returncode:
+        raise SystemExit('%s start failed with status %d' % (mode, process.returncode))
+    from django.utils import simplejson
+    return simplejson.loads(out)
+
+
+def median(values):
+    '''
+    >>> median([3, 1, 2]), median([4, 1, 2, 3])
+    (2, 2.5)
+    '''
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def summarize(cold, warm):
+    ''' Medians of the timings over the runs of each mode. '''
+    modules = {}
+    for run in cold:
+        for name, elapsed in run['modules'].items():
+            modules.setdefault(name, []).append(elapsed)
+    return {
+        'import_ms': median([run['import_ms'] for run in cold + warm]),
+        'cold_request_ms': median([run['first_request_ms'] for run in cold]),
+        'warmup_ms': median([run['warmup_ms'] for run in warm]),
+        'warm_request_ms': median([run['first_request_ms'] for run in warm]),
+        'modules': dict((name, median(values)) for name, values in modules.items()),
+        'errors': len([run for run in cold + warm if run['status'] >= 400]),
+        }
+
+
+def compare(result, baseline, tolerance):
+    '''
+    Lists the regressions of result against baseline: an import or a first
+    request more than tolerance slower.
+
+    >>> old = {'import_ms': 100.0, 'cold_request_ms': 50.0, 'warm_request_ms': 10.0}
+    >>> compare({'import_ms': 110.0, 'cold_request_ms': 50.0, 'warm_request_ms': 10.0}, old, 0.25)
+    []
+    >>> compare({'import_ms': 200.0, 'cold_request_ms': 50.0, 'warm_request_ms': 10.0}, old, 0.25)
+    ['import_ms 200.0 > 100.0']
+    '''
+    regressions = []
+    for name in ('import_ms', 'cold_request_ms', 'warm_request_ms'):
+        if result[name] > baseline[name] * (1 + tolerance):
+            regressions.append('%s %.1f > %.1f' % (name, result[name], baseline[name]))
+    return regressions
+
+
+def report(result, baseline, out=sys.stdout):
+    for name in ('import_ms', 'cold_request_ms', 'warmup_ms', 'warm_request_ms'):
+        diff = ''
+        if baseline and baseline.get(name):
+            diff = '%+.0f%%' % ((result[name] - baseline[name]) * 100 / baseline[name])
+        out.write('%-16s %9.1f %9s\n' % (name, result[name], diff))
+    if result['errors']:
+        out.write('errors: %d first requests answered with 4xx/5xx\n' % result['errors'])
+    out.write('\nslowest imports, self time in ms:\n')
+    slowest = sorted(result['modules'].items(), key=lambda item: -item[1])[:_SLOWEST]
+    for name, elapsed in slowest:
+        out.write('%9.1f  %s\n' % (elapsed, name))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]', description=__doc__.strip().split('\n\n')[0])
+    parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK', '/usr/local/google_appengine'),
+                      help='App Engine SDK directory [%default]')
+    parser.add_option('--runs', type='int', default=5, help='processes started in each mode [%default]')
+    parser.add_option('--url', default='/', help='first request [%default]')
+    benchmark.add_baseline_options(parser, _BASELINE)
+    parser.add_option('--child', choices=('cold', 'warm'), help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args(argv)
+
+    if options.child:
+        return child(options)
+
+    benchmark.setup_sdk(options.sdk)
+    cold = [run_child(options, 'cold') for i in range(options.runs)]
+    warm = [run_child(options, 'warm') for i in range(options.runs)]
+    result = summarize(cold, warm)
+    result['url'] = options.url
+    return benchmark.check_baseline(result, options, 'url', report, compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,31 @@
+/*
+ * Draws the thumbnails of a Galleria gallery created with
+ * thumbnails: 'empty' from a single sprite image.
+ */
+
+// Photo keys of the links in photos, in gallery order. Call it before
+// Galleria replaces the links.
+function photoKeys(photos) {
+    return $(photos).find('a').map(function() {
+        return $(this).attr('href').split('/').pop();
+    }).get();
+}
+
+function spriteThumbnails(gallery, keys) {
+    if (!keys.length) {
+        return;
+    }
+    $.getJSON('/photos/sprite', {keys: keys.join(',')}, function(sprite) {
+        $(gallery.get('thumbnails')).find('.galleria-image').each(function(i) {
+            var offset = sprite.offsets[keys[i]];
+            if (offset) {
+                $(this).find('.img').css({
+                    display: 'block',
+                    width: offset[2] + 'px',
+                    height: offset[3] + 'px',
+                    background: 'url(' + sprite.url + ') -' + offset[0] + 'px -' + offset[1] + 'px no-repeat'
+                });
+            }
+        });
+    });
+}
@@ -3,6 +3,8 @@
 
 from google.appengine.ext.webapp import template
 
+import assets
+
 def date_format(date, format=None):
     if not date:
         return ''
@@ -11,7 +13,19 @@ def date_format(date, format=None):
     return date.strftime(format)
 
 
+def asset_url(name):
+    ''' Fingerprinted URL of a file under static/. '''
+    return assets.url(name)
+
+
+def asset_tags(name):
+    ''' Script or stylesheet tags of a bundle, or of a file under static/. '''
+    return assets.tags(name)
+
+
 # Register the filter/templatetags functions
 register = template.create_template_register()
 register.filter(date_format)
+register.simple_tag(asset_url)
+register.simple_tag(asset_tags)
 
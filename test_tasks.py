@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+
+'''
+Tests of the background tasks and of the requests queuing them, run in
+process with LocalQueue against the App Engine SDK stand-ins:
+
+    APPENGINE_SDK=~/google_appengine python test_tasks.py
+'''
+
+import os
+import sys
+import datetime
+import unittest
+
+
+_SDK = os.environ.get('APPENGINE_SDK', '/usr/local/google_appengine')
+
+_INVITEES = ['ann@example.com', 'bob@example.com', 'carl@example.com']
+
+_sdk_ready = []
+
+
+def setup_sdk():
+    ''' Puts the SDK on sys.path once, or skips the tests without it. '''
+    if not _sdk_ready:
+        if not os.path.isdir(_SDK):
+            raise unittest.SkipTest('no App Engine SDK in %s, set APPENGINE_SDK' % _SDK)
+        import benchmark
+        benchmark.setup_sdk(_SDK)
+        _sdk_ready.append(benchmark)
+    return _sdk_ready[0]
+
+
+class TaskTestCase(unittest.TestCase):
+    '''
+    Fresh stand-ins and a LocalQueue for each test. The instance-local entity
+    cache is cleared too: each testbed hands out the same ids again.
+    '''
+    def setUp(self):
+        benchmark = setup_sdk()
+        self.bed, has_images = benchmark.setup_stubs()
+        import appointment
+        self.appointment = appointment
+        appointment.CachedModel._local.clear()
+        self.queue = appointment.LocalQueue()
+        self.saved_queue, appointment.task_queue = appointment.task_queue, self.queue
+
+    def tearDown(self):
+        self.appointment.task_queue = self.saved_queue
+        self.appointment.CachedModel._local.clear()
+        self.bed.deactivate()
+
+    def call(self, method, url, params=None, environ=None):
+        return self.appointment.call_application(self.appointment.application, method, url, params, environ)
+
+    def create(self, invitees=_INVITEES, dates=('2012-12-21 12:00',), storage='invites'):
+        ''' POST /new, returning the key of the appointment. '''
+        status, headers, body = self.call('POST', '/new', {
+            'description': 'Party',
+            'invitees': ', '.join(invitees),
+            'date[]': [d.split()[0] for d in dates],
+            'time[]': [d.split()[1] for d in dates],
+            'storage': storage,
+            })
+        self.assertEqual(status, 302)
+        location = dict(headers)['Location']
+        return location.split('key=')[1].split('&')[0]
+
+
+class MailTaskTest(TaskTestCase):
+    def setUp(self):
+        TaskTestCase.setUp(self)
+        self.mail_stub = self.bed.get_stub('mail')
+
+    def sent(self, subject):
+        return [m for m in self.mail_stub.get_sent_messages() if m.subject.startswith(subject)]
+
+    def test_new_only_queues_mails(self):
+        self.create()
+        self.assertEqual(self.mail_stub.get_sent_messages(), [])
+        self.assertEqual(set([url for url, params, retries in self.queue.tasks]), set(['/tasks/mail']))
+
+    def test_run_sends_one_invitation_per_invitee(self):
+        self.create()
+        self.queue.run(self.appointment.application)
+        self.assertEqual(self.queue.tasks, [])
+        self.assertEqual(sorted([m.to for m in self.sent('Invitation:')]), sorted(_INVITEES))
+        self.assertEqual(len(self.sent('Overview:')), 1)
+
+    def test_failed_invitation_is_queued_again(self):
+        key = self.create()
+        self.queue.tasks = []
+        mail = self.appointment.mail
+
+        class FailingMessage(mail.EmailMessage):
+            def send(self):
+                if self.to == 'bob@example.com':
+                    raise mail.Error('refused')
+                mail.EmailMessage.send(self)
+
+        class FailingMail(object):
+            EmailMessage = FailingMessage
+
+        self.appointment.mail = FailingMail
+        try:
+            status, headers, body = self.call('POST', '/tasks/mail',
+                {'key': key, 'host': 'localhost', 'invitee': _INVITEES, 'retries': 1})
+        finally:
+            self.appointment.mail = mail
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted([m.to for m in self.sent('Invitation:')]), ['ann@example.com', 'carl@example.com'])
+        self.assertEqual(len(self.queue.tasks), 1)
+        url, params, retries = self.queue.tasks[0]
+        self.assertEqual(url, '/tasks/mail')
+        self.assertEqual(params['invitee'], ['bob@example.com'])
+        self.assertEqual(params['retries'], 2)
+
+
+class ExportImportTest(TaskTestCase):
+    def post_import(self, data):
+        status, headers, body = self.call('POST', '/import?format=ndjson', environ={
+            'wsgi.input': self.appointment.StringIO(data),
+            'CONTENT_LENGTH': str(len(data)),
+            'CONTENT_TYPE': 'application/x-ndjson',
+            })
+        self.assertEqual(status, 200)
+        return self.appointment.simplejson.loads(body)
+
+    def assertConsistent(self, appointment):
+        ''' The stored tally counts what the records hold. '''
+        tally = appointment.tally()
+        counted = appointment.make_tally(appointment.availability_matrix()['status'])
+        for status in ('yes', 'maybe', 'no'):
+            self.assertEqual(tally[status], [getattr(counted, status)[slot] for slot in appointment.slots])
+
+    def test_round_trip(self):
+        Appointment = self.appointment.Appointment
+        dates = ('2012-12-21 12:00', '2012-12-22 12:00')
+        keys = [self.create(dates=dates, storage=storage) for storage in ('invites', 'compact')]
+        for key in keys:
+            Appointment.get(key).set_statuses([
+                ('ann@example.com', datetime.datetime(2012, 12, 21, 12), 'yes'),
+                ('bob@example.com', datetime.datetime(2012, 12, 22, 12), 'no'),
+                ])
+        status, headers, body = self.call('GET', '/export', {'kind': 'appointments'})
+        self.assertEqual(status, 200)
+
+        result = self.post_import(body)
+        self.assertEqual((result['imported'], result['errors']), (2, []))
+        for key in keys:
+            original = Appointment.get(key)
+            imported = Appointment.get_by_key_name('import:%s' % key)
+            self.assertEqual(imported.storage, original.storage)
+            self.assertEqual(imported.availability_matrix()['status'], original.availability_matrix()['status'])
+            self.assertEqual(imported.tally(), original.tally())
+            self.assertConsistent(imported)
+
+        result = self.post_import(body)
+        self.assertEqual((result['imported'], result['skipped']), (0, 2))
+
+    def test_irregular_rows(self):
+        record = {
+            'key': 'irregular', 'description': 'Party', 'name': 'owner', 'email': 'owner@example.com',
+            'invitees': _INVITEES, 'dates': ['2012-12-21 12:00', '2012-12-22 12:00'],
+            'status': {
+                'ann@example.com': ['yes', 'no', 'maybe'],
+                'bob@example.com': [None],
+                'carl@example.com': ['', 'unknown'],
+                },
+            }
+        result = self.post_import(self.appointment.simplejson.dumps(record) + '\n')
+        self.assertEqual((result['imported'], result['errors']), (1, []))
+        imported = self.appointment.Appointment.get_by_key_name('import:irregular')
+        status = imported.availability_matrix()['status']
+        self.assertEqual(status['ann@example.com'], ['yes', 'no'])
+        self.assertEqual(status['bob@example.com'], [imported.default_status('bob@example.com')] * 2)
+        self.assertConsistent(imported)
+
+
+class DeleteTaskTest(TaskTestCase):
+    def test_remove_large_appointment(self):
+        appointment = self.appointment
+        invitees = ['guest%d@example.com' % i for i in range(20)]
+        dates = ['2012-12-%02d 12:00' % day for day in range(1, 21)]
+        key = self.create(invitees=invitees, dates=dates)
+        records = appointment.Invite.all(keys_only=True).ancestor(appointment.db.Key(key)).count()
+        self.assertTrue(records > appointment._DELETE_BATCH_SIZE)
+
+        status, headers, body = self.call('POST', '/appointment/remove', {'key': key})
+        self.assertEqual(status, 200)
+        self.assertTrue(appointment.db.get(appointment.db.Key(key)).deleted)
+        self.queue.run(appointment.application)
+
+        self.assertEqual(appointment.Invite.all().count(), 0)
+        tally_keys = [appointment.AvailabilityTally.shard_key(appointment.db.Key(key), i)
+                      for i in range(appointment._TALLY_SHARDS)]
+        self.assertEqual([t for t in appointment.db.get(tally_keys) if t], [])
+        self.assertEqual(appointment.db.get(appointment.db.Key(key)), None)
+
+    def test_account_cleanup_needs_confirmation(self):
+        self.create()
+        self.queue.tasks = []
+        status, headers, body = self.call('POST', '/profile/remove')
+        self.assertEqual(status, 400)
+        self.assertEqual(self.queue.tasks, [])
+
+        status, headers, body = self.call('POST', '/profile/remove', {'confirm': 'owner@example.com'})
+        self.assertEqual(status, 200)
+        self.queue.run(self.appointment.application)
+        self.assertEqual(self.appointment.Appointment.all().count(), 0)
+        self.assertEqual(self.appointment.Invite.all().count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()